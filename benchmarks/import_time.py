@@ -0,0 +1,53 @@
+"""
+Measures how long it takes to import the Shapes API modules in a fresh interpreter
+and checks the result against a budget (in milliseconds).
+
+It also checks that importing has no process-wide side effects: no urllib2 opener
+is installed and no XML backend or DO opener has been set up yet.
+
+Run it from the root of the checkout (with a ``settings.py`` in place)::
+
+    python benchmarks/import_time.py [budget_ms] [runs]
+
+The exit status is non-zero if any module goes over budget.
+"""
+import os, sys, subprocess
+
+MODULES = ['shapesapi.dorepository', 'shapesapi.shapes', 'shapesapi']
+DEFAULT_BUDGET = 50.0 # milliseconds
+DEFAULT_RUNS = 7
+
+PROBE = """
+import time, urllib2
+start = time.time()
+import %(module)s
+elapsed = (time.time() - start) * 1000
+from shapesapi import dorepository
+assert urllib2._opener is None, "urllib2 opener installed on import"
+assert dorepository._etree is None, "XML backend probed on import"
+assert dorepository._opener is None, "DO opener created on import"
+print elapsed
+"""
+
+def measure(module, runs):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    timings = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', PROBE % {'module': module}], cwd=root)
+        timings.append(float(output.strip()))
+    timings.sort()
+    return timings[len(timings) // 2]
+
+def main(argv):
+    budget = float(argv[1]) if len(argv) > 1 else DEFAULT_BUDGET
+    runs = int(argv[2]) if len(argv) > 2 else DEFAULT_RUNS
+    over_budget = False
+    for module in MODULES:
+        median = measure(module, runs)
+        status = 'ok' if median <= budget else 'OVER BUDGET'
+        over_budget = over_budget or median > budget
+        print "%-25s %7.1fms (median of %d, budget %.0fms) %s" % (module, median, runs, budget, status)
+    return 1 if over_budget else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
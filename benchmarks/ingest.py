@@ -0,0 +1,55 @@
+"""
+Measures the work done on a shape file as it is uploaded: the lossless minification
+of SVG documents (``minify.minify_svg``) and the SHA-1 used to store identical files
+only once, in MB of SVG processed per second, along with the bytes saved.
+
+The SVG documents are generated to look like those drawn in an editor (indented
+elements, comments, paths with many points and a block of text) in several sizes;
+no DO repository is contacted.
+
+Run it from the root of the checkout (with a ``settings.py`` in place)::
+
+    python benchmarks/ingest.py [documents] [repeat]
+"""
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shapesapi.minify import minify_svg
+from shapesapi.dorepository import content_hash
+from serialization import timed
+
+def build_svg(elements):
+    lines = ['<?xml version="1.0" encoding="UTF-8" standalone="no"?>',
+             '<!-- Created with a vector editor -->',
+             '<svg xmlns="http://www.w3.org/2000/svg"',
+             '     xmlns:xlink="http://www.w3.org/1999/xlink"',
+             '     width="400"  height="400"  viewBox="0 0 400 400">',
+             '  <title>Benchmark shape</title>',
+             '  <g id="layer1"   transform="translate(10, 10)">']
+    for i in range(elements):
+        points = " ".join("L %d.%d %d.%d" % (i % 400, j, (i * j) % 400, j) for j in range(12))
+        lines.append('    <!-- part %d -->' % i)
+        lines.append('    <path id="path%d"\n          d="M 0 0 %s Z"\n          style="fill:#%06x;stroke:none" />' % (i, points, (i * 7919) % 0xffffff))
+        if i % 10 == 0:
+            lines.append('    <text x="%d" y="%d">  <tspan>Part</tspan> <tspan>%d</tspan>  </text>' % (i, i, i))
+    lines.extend(['  </g>', '</svg>', ''])
+    return "\n".join(lines)
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 100
+    repeat = int(argv[2]) if len(argv) > 2 else 5
+    print "%d documents of each size, best of %d runs" % (count, repeat)
+    for elements in (10, 100, 1000):
+        documents = [build_svg(elements + i % 3) for i in range(count)]
+        size = sum(len(document) for document in documents)
+        megabytes = size / 1048576.0
+        elapsed, minified = timed(lambda: [minify_svg(document) for document in documents], repeat)
+        saved = size - sum(len(document) for document in minified)
+        print "%5d elements minify %8.1fms %8.1f MB/s %10d -> %10d bytes (%4.1f%% saved)" % (
+            elements, elapsed * 1000, megabytes / elapsed, size, size - saved, 100.0 * saved / size)
+        elapsed, _ = timed(lambda: [content_hash(document) for document in minified], repeat)
+        print "%5d elements sha1   %8.1fms %8.1f MB/s" % (elements, elapsed * 1000, (size - saved) / 1048576.0 / elapsed)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,70 @@
+"""
+Compares the throughput of the XML and JSON representations of a shape listing.
+
+The shapes are built in memory (no DO repository is contacted), each with a file,
+a mask and a few categories, and rendered with and without details. Building the
+shared intermediate structure is timed separately from rendering it.
+
+Run it from the root of the checkout (with a ``settings.py`` in place)::
+
+    python benchmarks/serialization.py [shapes] [repeat]
+"""
+import os, sys, time, datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shapesapi import shapes, render
+from shapesapi.dorepository import DigitalObjectRepository, DigitalObject
+
+DO_URL = 'http://localhost/do/'
+
+def build_shapes(count, category_count=10, categories_per_shape=3):
+    repository = DigitalObjectRepository(DO_URL)
+    category_repository = shapes.CategoryRepository(repository=repository)
+    shape_repository = shapes.ShapeRepository(repository=repository)
+    categories = []
+    for i in range(category_count):
+        digital_object = DigitalObject(repository=repository, handle='cat/%d' % i, url='%scat%%2F%d/' % (DO_URL, i),
+                                       attributes={'name': 'Category %d' % i, 'type': 'category'})
+        categories.append(shapes.Category(digital_object=digital_object, repository=category_repository))
+    shape_list = shapes.ShapeList(repository=shape_repository, cache_size=None)
+    for i in range(count):
+        url = '%sshape%%2F%d/' % (DO_URL, i)
+        chosen = [categories[(i + j) % category_count] for j in range(categories_per_shape)]
+        digital_object = DigitalObject(repository=repository, handle='shape/%d' % i, url=url,
+                                       created=datetime.datetime(2012, 1, 1, 12, 0, i % 60),
+                                       attributes={'name': 'Shape %d' % i, 'type': 'shape', 'creator': 'Benchmark',
+                                                   'category': ",".join(c.handle for c in chosen)},
+                                       files={'content': {'url': url + 'el/content', 'filename': 'shape%d.svg' % i, 'mimetype': 'image/svg+xml'},
+                                              'mask': {'url': url + 'el/mask', 'filename': 'mask%d.svg' % i, 'mimetype': 'image/svg+xml'}})
+        shape = shapes.Shape(digital_object=digital_object, repository=shape_repository)
+        shape._categories = shapes.CategoryList(repository=category_repository, handles=[c.handle for c in chosen])
+        for category in chosen:
+            shape._categories.objects[category.handle] = category
+        shape_list.objects[shape.handle] = shape
+        shape_list.object_handles.append(shape.handle)
+    return shape_list
+
+def timed(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = function()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 1000
+    repeat = int(argv[2]) if len(argv) > 2 else 5
+    shape_list = build_shapes(count)
+    print "%d shapes, best of %d runs, JSON backend: %s" % (count, repeat, render.json_backend.__name__)
+    for details in (False, True):
+        data_time, data = timed(lambda: shape_list.data(details), repeat)
+        print "details=%-5s build data  %8.1fms %10.0f shapes/s" % (details, data_time * 1000, count / data_time)
+        for name, serializer in (('xml', lambda: render.shapes_xml(data)), ('json', lambda: render.to_json(data))):
+            elapsed, output = timed(serializer, repeat)
+            print "details=%-5s render %-4s %8.1fms %10.0f shapes/s %9d bytes" % (details, name, elapsed * 1000, count / elapsed, len(output))
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,109 @@
+"""
+Compares the escaped, template based XML rendering of shapes with the previous
+implementation, in elements (shapes and their files, masks and categories)
+rendered per second.
+
+The previous implementation is reproduced below as it was: every access to a
+shape's ``file`` or ``mask`` built a new ``ShapeFile`` and its URL, each element
+was formatted from a freshly built dictionary, and nothing was escaped. The shapes
+are built in memory by ``serialization.build_shapes``; no DO repository is contacted.
+
+Run it from the root of the checkout (with a ``settings.py`` in place)::
+
+    python benchmarks/xml_rendering.py [shapes] [repeat]
+"""
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shapesapi import shapes
+from shapesapi.shapes import settings
+from shapesapi.dorepository import escape_for_url
+from shapesapi.render import NAMESPACE
+from serialization import build_shapes, timed
+
+def legacy_file(shape, label):
+    do_file = shape.digital_object.files.get(label, None)
+    if do_file:
+        url = (settings.MASK_URL if label == 'mask' else settings.FILE_URL) % escape_for_url(shape.handle)
+        return shapes.ShapeFile(do_file=do_file, url=url, type='mask' if label == 'mask' else None)
+    return None
+
+def legacy_category_xml(category):
+    xml = []
+    xml.append('<Category id="%(handle)s" name="%(name)s"' % {
+                                                              'handle': category.digital_object.handle,
+                                                              'name': category.name,
+                                                              })
+    xml.append(' xlink:href="%(link)s"' % {'link': settings.CATEGORY_URL % escape_for_url(category.digital_object.handle)})
+    xml.append(' />')
+    return "".join(xml)
+
+def legacy_shape_xml(shape, namespace=True, details=True):
+    xml = []
+    xml.append('<Shape name="%(name)s" created="%(created)s" id="%(handle)s"%(namespace)s xlink:href="%(link)s"' % {
+        'name': shape.name,
+        'created': shape.created,
+        'handle': shape.handle,
+        'namespace': NAMESPACE if namespace else '',
+        'link': settings.SHAPE_URL % escape_for_url(shape.digital_object.handle)
+    })
+    if details:
+        xml.append('>')
+        for tag, label in (('File', 'content'), ('Mask', 'mask')):
+            if legacy_file(shape, label):
+                xml.append('<%(tag)s xlink:href="%(url)s" type="%(type)s" name="%(name)s" />' % {
+                                                                                     'tag': tag,
+                                                                                     'url': legacy_file(shape, label).url,
+                                                                                     'type': legacy_file(shape, label).mimetype,
+                                                                                     'name': legacy_file(shape, label).filename
+                                                                                     })
+        if shape.categories:
+            xml.append("<Categories%(namespace)s>%(cats)s</Categories>" % {'namespace': "", 'cats': "".join(legacy_category_xml(cat) for cat in shape.categories)})
+        xml.append("</Shape>")
+    else:
+        xml.append(" />")
+    return "".join(xml)
+
+def legacy_shapes_xml(shape_list, details=True):
+    return '<Shapes%(namespace)s>%(shapes)s</Shapes>' % {'namespace': NAMESPACE, 'shapes': "".join([legacy_shape_xml(shape, False, details) for shape in shape_list])}
+
+def forget_urls(shape_list):
+    """
+    Drop the memoized URLs and files, so each run of the new implementation starts cold.
+    """
+    for shape in shape_list.objects.values():
+        for name in ('url', 'file', 'mask'):
+            shape.__dict__.pop(name, None)
+        for category in shape.categories.objects.values():
+            category.__dict__.pop('url', None)
+
+def cold_timed(shape_list, details, repeat):
+    best = None
+    for _ in range(repeat):
+        forget_urls(shape_list)
+        elapsed, result = timed(lambda: shape_list.xml(True, details), 1)
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def count_elements(shape_list, details):
+    if not details:
+        return len(shape_list)
+    return sum(1 + len(shape.digital_object.files) + len(shape.categories) for shape in shape_list)
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 1000
+    repeat = int(argv[2]) if len(argv) > 2 else 5
+    shape_list = build_shapes(count)
+    print "%d shapes, best of %d runs" % (count, repeat)
+    for details in (False, True):
+        elements = count_elements(shape_list, details)
+        legacy_time, legacy = timed(lambda: legacy_shapes_xml(shape_list, details), repeat)
+        cold_time, cold = cold_timed(shape_list, details, repeat)
+        warm_time, warm = timed(lambda: shape_list.xml(True, details), repeat)
+        assert legacy == cold == warm, "the renderings differ"
+        for name, elapsed in (('previous', legacy_time), ('new, cold', cold_time), ('new, memoized', warm_time)):
+            print "details=%-5s %-14s %8.1fms %10.0f elements/s" % (details, name, elapsed * 1000, elements / elapsed)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,175 @@
+"""
+Admission control for the Shapes API server: decides, as each request comes in,
+whether to handle it now, queue it, or turn it away at once with a 503.
+
+Requests are grouped in classes by how much work they cause (serving a file or mask
+is cheap, listing every shape or exporting the library isn't). Each class has a
+priority, a limit on how many of its requests are handled at once and a longest
+acceptable wait. Requests over their class's limit, or over ``max_concurrent`` in
+all, wait in a single queue of at most ``max_queue`` requests and are let in by
+priority. A request is shed (its Future fails with ``Shed``) when
+
+- it has already waited longer than its class allows before it is even looked at
+  (the server is too busy to start on it in time), or does so in the queue;
+- the queue is full and no queued request has a lower priority, in which case the
+  lowest priority queued request is shed to make room instead.
+
+Under overload, expensive requests are turned away first and quickly, while cheap
+ones keep being served.
+
+>>> controller = AdmissionController({'cheap': RouteClass(0, 1, 5.0, 1), 'dear': RouteClass(1, 1, 5.0, 5)},
+...                                  max_concurrent=1, max_queue=1)
+>>> controller.admit('cheap').done()
+True
+>>> dear = controller.admit('dear')
+>>> dear.done()
+False
+>>> cheap = controller.admit('cheap')
+>>> dear.exception()
+Shed('dear',)
+>>> controller.release('cheap')
+>>> cheap.done(), controller.active
+(True, 1)
+>>> controller.admit('dear', waited=6.0).exception().retry_after
+5
+
+A request waiting for a slot of its own class doesn't hold up other classes:
+
+>>> controller = AdmissionController({'cheap': RouteClass(0, 1, 5.0, 1), 'dear': RouteClass(1, 1, 5.0, 5)},
+...                                  max_concurrent=3, max_queue=2)
+>>> controller.admit('cheap').done(), controller.admit('cheap').done()
+(True, False)
+>>> controller.admit('dear').done()
+True
+
+Listings past their limit of 4 at once queue for at most a second; once the queue
+is full, more are turned away at once, told to come back in 5 seconds:
+
+>>> controller = AdmissionController(ROUTE_CLASSES, max_concurrent=100, max_queue=1)
+>>> [controller.admit('listing').done() for i in range(5)]
+[True, True, True, True, False]
+>>> controller.admit('listing').exception().retry_after
+5
+>>> controller.admit('element').done(), dict(controller.shed_count)
+(True, {'listing': 1})
+"""
+import collections, itertools
+
+import tornado.concurrent
+import tornado.ioloop
+
+RouteClass = collections.namedtuple('RouteClass', 'priority concurrency max_wait retry_after')
+
+# priority (lower goes first), requests at once, longest wait in seconds, Retry-After when shed
+ROUTE_CLASSES = {
+    'element': RouteClass(0, 64, 5.0, 1),  # files and masks, mostly straight from the cache
+    'shape': RouteClass(1, 32, 2.0, 2),    # a single shape or bundle
+    'write': RouteClass(1, 8, 5.0, 2),     # creating, changing and deleting
+    'listing': RouteClass(2, 4, 1.0, 5),   # every shape or category, a category with its shapes
+    'bulk': RouteClass(3, 2, 0.5, 10),     # exports and batches
+}
+
+class Shed(Exception):
+    """
+    A request that was turned away; ask the client to come back after ``retry_after`` seconds.
+    """
+    def __init__(self, name, retry_after=1):
+        Exception.__init__(self, name)
+        self.name = name
+        self.retry_after = retry_after
+
+class Waiter(object):
+    def __init__(self, name, future):
+        self.name = name
+        self.future = future
+        self.timeout = None
+
+class AdmissionController(object):
+    def __init__(self, classes=ROUTE_CLASSES, max_concurrent=100, max_queue=200):
+        self.classes = classes
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.active = 0
+        self.active_by_class = collections.defaultdict(int)
+        self.waiting = []
+        self.counter = itertools.count()
+        self.shed_count = collections.defaultdict(int)
+
+    def has_class_room(self, name):
+        return self.active_by_class[name] < self.classes[name].concurrency
+
+    def has_room(self, name):
+        return self.active < self.max_concurrent and self.has_class_room(name)
+
+    def start(self, name):
+        self.active += 1
+        self.active_by_class[name] += 1
+
+    def shed(self, name, future):
+        self.shed_count[name] += 1
+        future.set_exception(Shed(name, self.classes[name].retry_after))
+
+    def admit(self, name, waited=0.0):
+        """
+        Returns a Future which is resolved when a request of class ``name`` may go ahead,
+        or fails with Shed if it is turned away. ``waited`` is how long the request has
+        been waiting already. Every admitted request must be released.
+        """
+        route = self.classes[name]
+        future = tornado.concurrent.Future()
+        if waited > route.max_wait:
+            self.shed(name, future)
+            return future
+        # only requests held up by max_concurrent, not by their own class, go first
+        ahead = any(priority <= route.priority and self.has_class_room(w.name) for priority, _, w in self.waiting)
+        if self.has_room(name) and not ahead:
+            self.start(name)
+            future.set_result(None)
+            return future
+        if len(self.waiting) >= self.max_queue:
+            victim = max(self.waiting)
+            if victim[0] <= route.priority:
+                self.shed(name, future)
+                return future
+            self.waiting.remove(victim)
+            self.drop(victim[2])
+        waiter = Waiter(name, future)
+        self.waiting.append((route.priority, next(self.counter), waiter))
+        self.waiting.sort()
+        io_loop = tornado.ioloop.IOLoop.current()
+        waiter.timeout = io_loop.call_later(route.max_wait - waited, self.expire, waiter)
+        return future
+
+    def drop(self, waiter):
+        if waiter.timeout is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(waiter.timeout)
+        self.shed(waiter.name, waiter.future)
+
+    def expire(self, waiter):
+        for entry in self.waiting:
+            if entry[2] is waiter:
+                self.waiting.remove(entry)
+                waiter.timeout = None
+                self.drop(waiter)
+                return
+
+    def release(self, name):
+        """
+        A request of class ``name`` is done; let in whoever is waiting and now fits.
+        """
+        self.active -= 1
+        self.active_by_class[name] -= 1
+        for entry in list(self.waiting):
+            if self.active >= self.max_concurrent:
+                break
+            waiter = entry[2]
+            if self.has_room(waiter.name):
+                self.waiting.remove(entry)
+                if waiter.timeout is not None:
+                    tornado.ioloop.IOLoop.current().remove_timeout(waiter.timeout)
+                self.start(waiter.name)
+                waiter.future.set_result(None)
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,199 @@
+"""
+Caches shared by all the processes serving the Shapes API.
+
+A ``DiskCache`` keeps each entry as a file in a local directory, so every worker
+process (including freshly restarted ones) can reuse what the others have already
+fetched or rendered. Entries are written to a temporary file and renamed into place,
+so readers never see a partially written entry. The expiry time of an entry is
+stored as the modification time of its file.
+
+Set ``CACHE_DIR`` in settings to enable caching; without it ``get_cache`` returns a
+``NullCache`` which never stores anything.
+
+>>> import tempfile
+>>> cache = DiskCache(tempfile.mkdtemp())
+>>> cache.get('shapes') is None
+True
+>>> cache.set('shapes', '<Shapes />')
+>>> cache.get('shapes')
+'<Shapes />'
+>>> cache.open('shapes').read(7)
+'<Shapes'
+>>> cache.set('expired', 'stale', timeout=-1)
+>>> cache.get_stale('expired', max_stale=60)
+('stale', False)
+>>> 'expired' in cache
+True
+>>> cache.get('expired', 'missing')
+'missing'
+>>> cache.delete('shapes')
+>>> cache.get('shapes') is None
+True
+"""
+import os, time, errno, hashlib, tempfile, shutil
+
+import settings
+
+FOREVER = 4102444800 # 2100-01-01, used as the expiry time of entries without a timeout
+
+class NullCache(object):
+    """
+    A cache which never stores anything; used when no ``CACHE_DIR`` is configured.
+    """
+    def get(self, key, default=None):
+        return default
+
+    def open(self, key):
+        return None
+
+    def get_stale(self, key, max_stale):
+        return None, False
+
+    def __contains__(self, key):
+        return False
+
+    def set(self, key, value, timeout=None):
+        pass
+
+    def touch(self, key, timeout):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+class DiskCache(object):
+    """
+    A cache of strings stored as files under ``directory``, safe to share between processes.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        digest = hashlib.sha1(key).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def get(self, key, default=None):
+        path = self.path(key)
+        try:
+            if os.path.getmtime(path) < time.time():
+                self._remove(path)
+                return default
+            with open(path, 'rb') as cached:
+                return cached.read()
+        except (IOError, OSError):
+            return default
+
+    def get_stale(self, key, max_stale):
+        """
+        Returns a (value, fresh) tuple for ``key``. An entry that expired less than
+        ``max_stale`` seconds ago is still returned, with ``fresh`` False, so it can be
+        served while it is being refreshed; (None, False) if there is no such entry.
+        """
+        path = self.path(key)
+        try:
+            expires = os.path.getmtime(path)
+            now = time.time()
+            if expires + max_stale < now:
+                self._remove(path)
+                return None, False
+            with open(path, 'rb') as cached:
+                return cached.read(), expires >= now
+        except (IOError, OSError):
+            return None, False
+
+    def __contains__(self, key):
+        """
+        Whether there is an entry for ``key``, fresh or not.
+        """
+        return os.path.exists(self.path(key))
+
+    def open(self, key):
+        """
+        Returns the entry for ``key`` as a file open for reading, or None, so that
+        parts of a large entry can be read without loading all of it.
+        """
+        path = self.path(key)
+        try:
+            if os.path.getmtime(path) < time.time():
+                self._remove(path)
+                return None
+            return open(path, 'rb')
+        except (IOError, OSError):
+            return None
+
+    def set(self, key, value, timeout=None):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        path = self.path(key)
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError, inst:
+            if inst.errno != errno.EEXIST:
+                raise
+        fd, temp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as temp:
+                if hasattr(value, 'save'): # a body spooled to a file
+                    value.save(temp)
+                else:
+                    temp.write(value)
+            now = time.time()
+            os.utime(temp_path, (now, now + timeout if timeout is not None else FOREVER))
+            os.rename(temp_path, path)
+        except:
+            self._remove(temp_path)
+            raise
+
+    def touch(self, key, timeout):
+        """
+        Makes the entry for ``key``, if there is one, fresh for another ``timeout`` seconds.
+        """
+        now = time.time()
+        try:
+            os.utime(self.path(key), (now, now + timeout))
+        except OSError:
+            pass
+
+    def delete(self, key):
+        self._remove(self.path(key))
+
+    def clear(self):
+        """
+        Remove every entry. The directory is renamed out of the way first so that
+        other processes immediately stop seeing the old entries.
+        """
+        trash = '%s.%d.%d' % (self.directory, os.getpid(), time.time() * 1000)
+        try:
+            os.rename(self.directory, trash)
+        except OSError:
+            return
+        shutil.rmtree(trash, ignore_errors=True)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+_caches = {}
+def get_cache(name):
+    """
+    Returns the shared cache called ``name`` (for example 'xml' or 'files').
+    """
+    if name not in _caches:
+        cache_dir = getattr(settings, 'CACHE_DIR', None)
+        if cache_dir:
+            _caches[name] = DiskCache(os.path.join(cache_dir, name))
+        else:
+            _caches[name] = NullCache()
+    return _caches[name]
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -10,6 +10,12 @@ same directory called ``settings.py`` which contains the following::
     DO_PASSWORD = password
     DO_URL = http://example.com:8810/do/
 
+``DO_URL`` can also be a list of shards, each of them a URL or a list of the URLs of
+its replicas, for example ``[['http://a1:8810/do/', 'http://a2:8810/do/'], 'http://b:8810/do/']``.
+Reads are spread over the healthy replicas of a shard while writes go to its first
+URL, new objects are placed on a shard by consistent hashing, and listings and
+searches are sent to every shard and their results merged.
+
 Create a digital object in the repository by using the ``create`` method of a ``DigitalObjectRepository`` 
 object. Creating a DigitalObject object does *not* create a record in the repository.
 
@@ -17,6 +23,13 @@ You use the DigitalObject record to get and set attributes using the ``set`` and
 
 Add a file to a digital object using the ``put_file`` method of the DigitalObject object. 
 Creating a DigitalObjectFile object does *not* create a record in the repository.
+Files are stored once however many objects they are uploaded to: the SHA-1 of each
+file is kept in an attribute of its object (``<element>_sha1``), and from the second
+upload of the same content on (of at least ``settings.DEDUP_MIN_SIZE`` bytes) the element
+refers to the one holding the body (``reference``) instead of being sent the body again.
+An object whose files others refer to isn't deleted but kept, out of listings, as an
+object of type ``blob`` until the last of them is deleted or replaced; see
+``DigitalObject.delete`` and ``DigitalObjectRepository.collect_blobs``.
 
 To retrieve a given stored file as a file object (which you can read), use the `get_file` method of 
 the DigitalObject object.
@@ -70,29 +83,12 @@ True
 0
 """    
 
-import urllib2, urllib, base64, datetime, mimetypes, sys, os, time
+import urllib2, urllib, httplib, socket, base64, datetime, mimetypes, sys, os, time
+import random, copy, threading, collections, Queue, tempfile, mmap, hashlib, bisect, itertools, uuid
 from StringIO import StringIO
-import poster
-
-try:
-    import lxml.etree as ET
-    ET.fromstring('<root><parent name="senior"><child name="junior" /></parent></root>').findall('.//child[@name="junior"]')
-except (ImportError, SyntaxError):
-    try:
-        import xml.etree.cElementTree as ET
-        ET.fromstring('<root><parent name="senior"><child name="junior" /></parent></root>').findall('.//child[@name="junior"]')
-    except ImportError:
-        import xml.etree.ElementTree as ET
-
-try:
-    ET.fromstring('<root><parent name="senior"><child name="junior" /></parent></root>').findall('.//child[@name="junior"]')
-except SyntaxError:
-    raise Exception("Can't run server on this machine. You need to have a ElementTree module that supports XPath queries.")
 
 import settings
 
-poster.streaminghttp.register_openers()
-
 class DORepositoryException(Exception):
     pass
 
@@ -120,6 +116,57 @@ class DORepositoryConnectionError(DORepositoryException):
                        " :%s" % self.reason if self.reason else "" 
                        ])
 
+class DORepositoryUnavailable(DORepositoryConnectionError):
+    """
+    Raised without contacting the repository while it is considered unhealthy.
+    """
+    def __init__(self, retry_after=None):
+        self.reason = "repository unavailable"
+        self.retry_after = retry_after
+
+class DeadlineExceeded(DORepositoryException):
+    def __init__(self, deadline=None):
+        self.deadline = deadline
+
+    def __str__(self):
+        return "Deadline for requests to the repository has passed"
+
+XPATH_PROBE = '<root><parent name="senior"><child name="junior" /></parent></root>'
+ETREE_BACKENDS = ('lxml.etree', 'xml.etree.cElementTree', 'xml.etree.ElementTree')
+
+_etree = None
+def get_etree():
+    """
+    Returns the fastest available ElementTree module that supports the XPath queries
+    used by this module. The backends are only probed the first time this is called.
+    """
+    global _etree
+    if _etree is None:
+        for backend in ETREE_BACKENDS:
+            try:
+                module = __import__(backend, fromlist=['fromstring'])
+                module.fromstring(XPATH_PROBE).findall('.//child[@name="junior"]')
+            except (ImportError, SyntaxError):
+                continue
+            _etree = module
+            break
+        else:
+            raise DORepositoryException("Can't run server on this machine. You need to have a ElementTree module that supports XPath queries.")
+    return _etree
+
+MODIFIED_ATTRIBUTE = 'internal.modified'
+
+OBJECT_CACHE_SIZE = getattr(settings, 'OBJECT_CACHE_SIZE', 1000)
+KEEP_FILE_BODIES = getattr(settings, 'KEEP_FILE_BODIES', True)
+SPOOL_THRESHOLD = getattr(settings, 'SPOOL_THRESHOLD', 1024 * 1024)
+SPOOL_DIR = getattr(settings, 'SPOOL_DIR', None)
+SPOOL_CHUNK_SIZE = 64 * 1024
+SHARD_VIRTUAL_NODES = getattr(settings, 'SHARD_VIRTUAL_NODES', 64)
+LOCATION_CACHE_SIZE = getattr(settings, 'LOCATION_CACHE_SIZE', 100000)
+HEALTH_CHECK_QUERY = 'objatt_type:healthcheck'
+DEDUP_MIN_SIZE = getattr(settings, 'DEDUP_MIN_SIZE', 4096)
+BLOB_TYPE = 'blob'
+
 NONSTANDARD_MIME_TYPES = {
     'svg': 'image/svg+xml',
     'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
@@ -134,9 +181,31 @@ def guess_type(filename):
 def escape_for_url(s):
     return urllib.quote_plus(s).replace('%3A',':').replace('%29',')').replace('%28','(')
 
+def same_element(url, other):
+    """
+    Whether ``url`` and ``other`` are the URL of the same element, which is written
+    with or without a trailing slash.
+
+    >>> same_element('http://do/x/el/content', 'http://do/x/el/content/')
+    True
+    >>> same_element(None, 'http://do/x/el/content/')
+    False
+    """
+    return bool(url) and bool(other) and url.rstrip('/') == other.rstrip('/')
+
+def parse_timestamp(doobj, name):
+    """
+    Returns the value of the ``name`` attribute of a <do> element (milliseconds since
+    the epoch) as a datetime, or None if the element doesn't have that attribute.
+    """
+    attributes = doobj.findall("att[@name='%s']" % name)
+    if not attributes:
+        return None
+    return datetime.datetime.fromtimestamp(int(attributes[0].get('value'))/1000)
+
 def parse_objects(data, url):
     result = []
-    doc = ET.fromstring(data)
+    doc = get_etree().fromstring(data)
     for doobj in doc.findall('do'):
         obj = {}
         handle = doobj.get('id')
@@ -144,8 +213,8 @@ def parse_objects(data, url):
         obj['url'] = '%s%s/' % (url, escape_for_url(handle))
         attlist = doobj.findall('att')
         if attlist:
-            createdms = int(doobj.findall("att[@name='internal.created']")[0].get('value'))
-            obj['created'] = datetime.datetime.fromtimestamp(createdms/1000)
+            obj['created'] = parse_timestamp(doobj, 'internal.created')
+            obj['modified'] = parse_timestamp(doobj, MODIFIED_ATTRIBUTE)
             data = {}
             for a in attlist:
                 if 'internal.' in a:
@@ -173,13 +242,13 @@ def parse_objects(data, url):
 
 def parse_object(data, url):
     result = {}
-    doc = ET.fromstring(data)
+    doc = get_etree().fromstring(data)
     doobj = doc.findall('do')[0]
     handle = doobj.get('id')
     result['handle'] = handle
     result['url'] = '%s%s/' % (url, escape_for_url(handle))
-    createdms = int(doobj.findall("att[@name='internal.created']")[0].get('value'))
-    result['created'] = datetime.datetime.fromtimestamp(createdms/1000)
+    result['created'] = parse_timestamp(doobj, 'internal.created')
+    result['modified'] = parse_timestamp(doobj, MODIFIED_ATTRIBUTE)
     data = {}
     for e in doobj.findall('att'):
         key = e.get('name')
@@ -216,10 +285,13 @@ def get_file_container(file):
             file_container['mimetype']=ct
     except AttributeError:
         file_container['filename']=file['filename']
-        file_container['mimetype']=file['content_type']
+        file_container['mimetype']=file.get('content_type', file.get('mimetype'))
         file_container['body']=file['body']
     return file_container
 
+def content_hash(body):
+    return hashlib.sha1(body).hexdigest()
+
 
 
 class RequestWithMethod(urllib2.Request):
@@ -239,37 +311,525 @@ class AuthenticatedRequest(RequestWithMethod):
         self.add_header('Authorization', 'Basic %s' % auth ) # Add Auth header to request
 
 
+RETRY_METHODS = ('GET',)
+
+_context = threading.local()
+
+class Deadline(object):
+    """
+    The time by which a piece of work (like answering an HTTP request) has to be done.
+
+    While a deadline is active (``with Deadline(5):``) every request the current thread
+    makes to the repository gets at most the remaining time as its timeout, and once
+    the deadline has passed requests fail immediately with DeadlineExceeded. Code that
+    can do without some of its results records what it left out with ``degrade``.
+
+    The deadline follows the work into the threads it is spread over (``parallel_map``,
+    hedged requests), so the ``listeners`` of a deadline are called, like those of the
+    opener, after every round trip made for that piece of work and no other.
+    """
+    def __init__(self, seconds):
+        self.expires = time.time() + seconds
+        self.degraded = []
+        self.listeners = []
+
+    def remaining(self):
+        return self.expires - time.time()
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+    def degrade(self, what):
+        if what not in self.degraded:
+            self.degraded.append(what)
+
+    def __enter__(self):
+        if not hasattr(_context, 'deadlines'):
+            _context.deadlines = []
+        _context.deadlines.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self in _context.deadlines:
+            _context.deadlines.remove(self)
+
+def current_deadline():
+    """
+    Returns the innermost active Deadline of the current thread, or None.
+    """
+    deadlines = getattr(_context, 'deadlines', None)
+    return deadlines[-1] if deadlines else None
+
+def parallel_map(function, items, max_workers=None):
+    """
+    Calls ``function`` on each of ``items`` from up to ``max_workers`` threads (one per
+    item by default) and returns the results in order. The current deadline applies in
+    the worker threads as well. If any call fails, the exception of the first failing
+    item is raised once every call has finished.
+
+    >>> parallel_map(lambda x: x * 2, [1, 2, 3], max_workers=2)
+    [2, 4, 6]
+    """
+    items = list(items)
+    if len(items) <= 1:
+        return [function(item) for item in items]
+    deadline = current_deadline()
+    results = [None] * len(items)
+    errors = []
+    indices = Queue.Queue()
+    for index in range(len(items)):
+        indices.put(index)
+
+    def work():
+        if deadline:
+            deadline.__enter__()
+        try:
+            while True:
+                try:
+                    index = indices.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[index] = function(items[index])
+                except Exception:
+                    errors.append((index, sys.exc_info()))
+        finally:
+            if deadline:
+                deadline.__exit__()
+
+    threads = [threading.Thread(target=work) for _ in range(min(max_workers or len(items), len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        exc_type, exc_value, exc_traceback = min(errors)[1]
+        raise exc_type, exc_value, exc_traceback
+    return results
+
+def is_transient(error):
+    """
+    True if ``error`` says the repository is struggling (no connection, a timeout,
+    a 5xx response) rather than that there is something wrong with the request.
+    """
+    if isinstance(error, urllib2.HTTPError):
+        return error.code >= 500
+    return isinstance(error, (urllib2.URLError, socket.error, httplib.HTTPException))
+
+class LatencyTracker(object):
+    """
+    Keeps the latencies of the most recent requests to estimate percentiles.
+    """
+    def __init__(self, size=200, minimum=20):
+        self.samples = collections.deque(maxlen=size)
+        self.minimum = minimum
+
+    def add(self, elapsed):
+        self.samples.append(elapsed)
+
+    def percentile(self, percent):
+        """
+        Returns the latency below which ``percent`` percent of the recent requests fell,
+        or None if there haven't been enough requests yet to tell.
+        """
+        samples = sorted(self.samples)
+        if len(samples) < self.minimum:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100.0))]
+
+class CircuitBreaker(object):
+    """
+    Stops calls to a repository that keeps failing. After ``threshold`` consecutive
+    failures the circuit opens and calls fail immediately with DORepositoryUnavailable.
+    Once ``reset_timeout`` seconds have passed a single trial call is let through;
+    the circuit closes again if it succeeds.
+    """
+    def __init__(self, threshold=5, reset_timeout=30.0):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def before_request(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            remaining = self.opened_at + self.reset_timeout - time.time()
+            if remaining > 0 or self.trial:
+                raise DORepositoryUnavailable(retry_after=max(remaining, 1))
+            self.trial = True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.threshold:
+                self.opened_at = time.time()
+            self.trial = False
+
+    def release(self):
+        """
+        End a trial call that got no answer either way (the caller gave up on it), so
+        that the next call can be the trial.
+        """
+        with self.lock:
+            self.trial = False
+
+    def trip(self):
+        """
+        Open the circuit right away, as when a health check fails.
+        """
+        with self.lock:
+            self.opened_at = time.time()
+            self.trial = False
+
+    @property
+    def available(self):
+        """
+        Whether a call would be let through now (without starting a trial call).
+        """
+        with self.lock:
+            return self.opened_at is None or (not self.trial and time.time() >= self.opened_at + self.reset_timeout)
+
+class Replica(object):
+    """
+    One of the servers holding a shard, with a CircuitBreaker of its own.
+    """
+    def __init__(self, url, breaker=None):
+        self.url = url
+        self.breaker = breaker
+
+    @property
+    def available(self):
+        return self.breaker is None or self.breaker.available
+
+class ReplicaSet(object):
+    """
+    The servers holding one shard of the repository. Objects are known by the URL of
+    the first one (the primary), which takes all the writes; reads are spread over the
+    replicas whose circuit is closed, in turn.
+    """
+    def __init__(self, urls):
+        self.url = urls[0]
+        self.replicas = [Replica(url, new_breaker()) for url in urls]
+        self.primary = self.replicas[0]
+        self.counter = itertools.count()
+
+    def choose(self, tried=()):
+        """
+        The replica for the next read, preferring available replicas not ``tried`` yet.
+        """
+        candidates = [r for r in self.replicas if r.available and r not in tried] or \
+                     [r for r in self.replicas if r not in tried] or self.replicas
+        return candidates[next(self.counter) % len(candidates)]
+
+    def retarget(self, request, replica):
+        """
+        ``request`` (made for the primary's URL) sent to ``replica`` instead.
+        """
+        if replica is self.primary:
+            return request
+        url = replica.url + request.get_full_url()[len(self.url):]
+        retargeted = RequestWithMethod(request.get_method(), url, data=request.get_data(), headers=dict(request.headers))
+        retargeted.unredirected_hdrs = dict(request.unredirected_hdrs)
+        return retargeted
+
+    def check_health(self, timeout=5.0):
+        """
+        Probe every replica with a search that matches nothing; the circuit of a replica
+        that doesn't answer is opened, that of one that does is closed. Replicas without
+        a circuit breaker (``settings.DO_BREAKER_THRESHOLD`` is 0) are always used, so
+        they aren't probed.
+        """
+        opener = get_opener()
+        for replica in self.replicas:
+            if replica.breaker is None:
+                continue
+            probe = AuthenticatedRequest(opener.username, opener.password, 'GET',
+                                         replica.url + '?query=%s' % escape_for_url(HEALTH_CHECK_QUERY))
+            try:
+                opener.urlopener.open(probe, timeout=timeout).close()
+            except Exception, inst:
+                if is_transient(inst):
+                    replica.breaker.trip()
+                    continue
+            replica.breaker.record_success()
+
+def hash_key(key):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+class HashRing(object):
+    """
+    Consistent hashing of keys onto nodes: each node gets ``virtual_nodes`` points on
+    a ring and a key goes to the node of the first point after its hash, so adding a
+    node only moves the keys that land on its points.
+
+    >>> ring = HashRing(['a', 'b', 'c'])
+    >>> ring.node('1234/5') == ring.node('1234/5')
+    True
+    >>> bigger = HashRing(['a', 'b', 'c', 'd'])
+    >>> moved = [key for key in map(str, range(1000)) if ring.node(key) != bigger.node(key)]
+    >>> all(bigger.node(key) == 'd' for key in moved), 150 < len(moved) < 350
+    (True, True)
+    """
+    def __init__(self, nodes, virtual_nodes=64):
+        self.points = sorted((hash_key('%s#%d' % (node, i)), node) for node in nodes for i in range(virtual_nodes))
+        self.hashes = [point for point, node in self.points]
+
+    def node(self, key):
+        index = bisect.bisect(self.hashes, hash_key(key)) % len(self.points)
+        return self.points[index][1]
+
 class AuthorizedOpener(object):
     """
     This code creates a request with basic authentication
+
+    Every request gives up after ``timeout`` seconds. Failed GETs are retried up to
+    ``retries`` times after a jittered, exponentially growing delay (starting at
+    ``backoff`` seconds, never more than ``max_backoff``). If ``hedge_percentile`` is
+    set, a GET that hasn't been answered within that percentile of recent latencies
+    is sent a second time and whichever answer comes first is used. A ``breaker``
+    (a CircuitBreaker) makes calls fail fast while the repository is unhealthy.
     """
-    def __init__(self, username=None, password=None):
+    def __init__(self, username=None, password=None, timeout=None, retries=0, backoff=0.1,
+                 max_backoff=2.0, hedge_percentile=None, breaker=None):
         self.username = username
         self.password = password
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_percentile = hedge_percentile
+        self.breaker = breaker
+        self.latency = LatencyTracker()
         self.requests = 0
         self.errors = 0
+        self.time = 0.0
+        self.listeners = []
+        self.replica_sets = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def add_replica_set(self, replica_set):
+        """
+        Route the requests for URLs under the primary URL of ``replica_set`` through it.
+        """
+        self.replica_sets[replica_set.url] = replica_set
+
+    def replica_set_for(self, url):
+        for prefix, replica_set in self.replica_sets.items():
+            if url.startswith(prefix):
+                return replica_set
+        return None
+
+    @property
+    def request(self):
+        return self.local.request
+
+    @request.setter
+    def request(self, request):
+        self.local.request = request
+
+    @property
+    def response(self):
+        return self.local.response
+
+    @response.setter
+    def response(self, response):
+        self.local.response = response
+
+    def add_listener(self, listener):
+        """
+        Register a callable which is called as ``listener(method, url, elapsed)`` after every
+        round trip to the repository. ``method`` is None when ``elapsed`` is the time spent
+        reading the body of the previous response.
+        """
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    @property
+    def urlopener(self):
+        """
+        A private urllib2 opener with poster's streaming handlers, built on first use
+        so that importing this module doesn't install anything process-wide.
+        """
+        if not hasattr(self, '_urlopener'):
+            from poster.streaminghttp import get_handlers
+            self._urlopener = urllib2.build_opener(*get_handlers())
+        return self._urlopener
 
-    def _make_request(self, url, files=None, data=None, body=None, method='GET'):
+    def _notify(self, method, url, elapsed):
+        with self.lock:
+            self.time += elapsed
+            listeners = list(self.listeners)
+        deadline = current_deadline()
+        if deadline:
+            listeners.extend(deadline.listeners)
+        for listener in listeners:
+            listener(method, url, elapsed)
+
+    def _timed_open(self, request, timeout):
+        method = request.get_method()
+        start = time.time()
+        try:
+            response = self.urlopener.open(request, timeout=timeout)
+        except (urllib2.URLError, socket.error, httplib.HTTPException), inst:
+            with self.lock:
+                self.errors += 1
+            if not isinstance(inst, urllib2.URLError):
+                raise urllib2.URLError(inst)
+            raise
+        else:
+            with self.lock:
+                self.requests += 1
+            if method == 'GET':
+                self.latency.add(time.time() - start)
+            return response
+        finally:
+            self._notify(method, request.get_full_url(), time.time() - start)
+
+    def _hedged_open(self, request, timeout):
+        threshold = self.latency.percentile(self.hedge_percentile)
+        if threshold is None:
+            return self._timed_open(request, timeout)
+        results = Queue.Queue()
+        deadline = current_deadline()
+
+        def attempt(request):
+            if deadline:
+                deadline.__enter__()
+            try:
+                results.put((True, self._timed_open(request, timeout)))
+            except Exception, inst:
+                results.put((False, inst))
+            finally:
+                if deadline:
+                    deadline.__exit__()
+
+        def start(request):
+            thread = threading.Thread(target=attempt, args=(request,))
+            thread.daemon = True
+            thread.start()
+
+        start(request)
+        try:
+            outstanding = 0
+            succeeded, result = results.get(timeout=threshold)
+        except Queue.Empty:
+            hedge = copy.copy(request)
+            hedge.headers = dict(request.headers)
+            hedge.unredirected_hdrs = dict(request.unredirected_hdrs)
+            start(hedge)
+            outstanding = 1
+            succeeded, result = results.get()
+            if not succeeded:
+                outstanding = 0
+                succeeded, result = results.get()
+        if outstanding:
+            def close_loser():
+                loser_succeeded, loser = results.get()
+                if loser_succeeded:
+                    loser.close()
+            closer = threading.Thread(target=close_loser)
+            closer.daemon = True
+            closer.start()
+        if not succeeded:
+            raise result
+        return result
+
+    def _open(self, request):
+        """
+        Sends ``request``, retrying and hedging as configured. Requests for a replicated
+        shard are sent to one of its replicas (each retry to another one if there is
+        another) and only count against that replica's circuit; writes always go to the
+        primary.
+        """
+        method = request.get_method()
+        attempts = self.retries + 1 if method in RETRY_METHODS else 1
+        replica_set = self.replica_set_for(request.get_full_url())
+        if replica_set and method in RETRY_METHODS:
+            attempts = max(attempts, len(replica_set.replicas))
+        tried = []
+        deadline = current_deadline()
+        for attempt in range(attempts):
+            timeout = self.timeout
+            if deadline:
+                remaining = deadline.remaining()
+                if remaining <= 0:
+                    raise DeadlineExceeded(deadline)
+                timeout = min(timeout, remaining) if timeout else remaining
+            breaker, target = self.breaker, request
+            if replica_set:
+                replica = replica_set.choose(tried) if method in RETRY_METHODS else replica_set.primary
+                tried.append(replica)
+                breaker, target = replica.breaker, replica_set.retarget(request, replica)
+            if breaker:
+                breaker.before_request()
+            try:
+                if method == 'GET' and self.hedge_percentile:
+                    response = self._hedged_open(target, timeout)
+                else:
+                    response = self._timed_open(target, timeout)
+            except urllib2.URLError, inst:
+                if not is_transient(inst):
+                    if breaker:
+                        breaker.record_success()
+                    raise
+                if breaker:
+                    breaker.record_failure()
+                if attempt == attempts - 1:
+                    raise
+                if replica_set and len(tried) < len(replica_set.replicas):
+                    continue # another replica can be tried straight away
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+                if deadline and delay >= deadline.remaining():
+                    raise DeadlineExceeded(deadline)
+                time.sleep(delay)
+            except DeadlineExceeded:
+                if breaker:
+                    breaker.release()
+                raise
+            except Exception:
+                if breaker:
+                    breaker.record_failure()
+                raise
+            else:
+                if breaker:
+                    breaker.record_success()
+                return response
+
+    def _make_request(self, url, files=None, data=None, body=None, method='GET', headers=None):
         assert(body == None or (data == None and files == None)) # if body is given, files and data must be empty  
         params = data or {}
         if files:
             for n, f in files.items():
                 params[n] = f[0]['body']
-        headers = {}
+        headers = dict(headers or {})
         if params:
-            data, headers = poster.encode.multipart_encode(params)
+            from poster.encode import multipart_encode
+            data, multipart_headers = multipart_encode(params)
+            headers.update(multipart_headers)
         elif body:
             data = body
         self.request = AuthenticatedRequest(self.username, self.password, method, url, data=data, headers=headers)
-        try:
-            self.response = urllib2.urlopen(self.request)
-            self.requests += 1
-        except urllib2.URLError:
-            self.errors += 1
-            raise
+        self.response = self._open(self.request)
             
-    def get(self, url):
-        self._make_request(url, method='GET')
+    def get(self, url, headers=None):
+        self._make_request(url, method='GET', headers=headers)
     
     def post(self, url, files=None, data=None, body=None):
         self._make_request(url, files=files, data=data, body=body, method='POST')
@@ -281,13 +841,17 @@ class AuthorizedOpener(object):
         data = file['body']
         headers = {}
         self.request = AuthenticatedRequest(self.username, self.password, 'PUT', url, data=data, headers=headers)
-        self.response = urllib2.urlopen(self.request)        
+        self.response = self._open(self.request)
     
     def delete(self, url):
         self._make_request(url, method='DELETE')
     
-    def read(self):
-        return self.response.read()
+    def read(self, size=-1):
+        start = time.time()
+        try:
+            return self.response.read(size)
+        finally:
+            self._notify(None, self.request.get_full_url(), time.time() - start)
 
     @property
     def headers(self):
@@ -295,10 +859,133 @@ class AuthorizedOpener(object):
 
 
 
+class MappedReader(object):
+    """
+    A file-like reader of a memory map; unlike the map itself, ``read`` may be called
+    without a size.
+    """
+    def __init__(self, map):
+        self.map = map
+        self.seek, self.tell, self.readline = map.seek, map.tell, map.readline
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self.map) - self.map.tell()
+        return self.map.read(size)
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        self.map.close()
+
+class MappedBody(object):
+    """
+    A body held in a file (a temporary file it was spooled to, or an entry of a disk
+    cache) and read through a read-only memory map, so reading or copying it doesn't
+    need the whole body in memory as a string. ``str(body)`` makes that string. The
+    map and file are closed with ``close`` or when the body is no longer referenced.
+
+    >>> body = spool(StringIO('x' * 10).read, threshold=4)
+    >>> len(body), body[2:5]
+    (10, 'xxx')
+    >>> reader = body.open()
+    >>> reader.seek(8); reader.read()
+    'xx'
+    >>> str(spool(StringIO('small').read, threshold=4096))
+    'small'
+    """
+    def __init__(self, file):
+        self.file = file
+        self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.map)
+
+    def __getitem__(self, index):
+        return self.map[index]
+
+    def __str__(self):
+        return self.map[:]
+
+    def open(self):
+        """
+        Returns a file-like reader of the body with a position of its own.
+        """
+        return MappedReader(mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def chunks(self, size=SPOOL_CHUNK_SIZE):
+        for start in xrange(0, len(self.map), size):
+            yield self.map[start:start + size]
+
+    def save(self, file):
+        """
+        Writes the body to ``file`` (an open file) straight from the memory map.
+        """
+        for start in xrange(0, len(self.map), SPOOL_CHUNK_SIZE):
+            file.write(buffer(self.map, start, SPOOL_CHUNK_SIZE))
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+def spool(read, threshold=SPOOL_THRESHOLD):
+    """
+    Reads a body with ``read`` (like the ``read`` method of a file) and returns it as a
+    string, or as a MappedBody of a temporary file if it is larger than ``threshold``
+    bytes (None for no limit).
+    """
+    chunks = []
+    size = 0
+    while True:
+        chunk = read(SPOOL_CHUNK_SIZE)
+        if not chunk:
+            return "".join(chunks)
+        chunks.append(chunk)
+        size += len(chunk)
+        if threshold is not None and size > threshold:
+            break
+    spooled = tempfile.TemporaryFile(dir=SPOOL_DIR)
+    try:
+        for chunk in chunks:
+            spooled.write(chunk)
+        chunks = None
+        chunk = read(SPOOL_CHUNK_SIZE)
+        while chunk:
+            spooled.write(chunk)
+            chunk = read(SPOOL_CHUNK_SIZE)
+        spooled.flush()
+        return MappedBody(spooled)
+    except:
+        spooled.close()
+        raise
+
+def file_body(file, threshold=SPOOL_THRESHOLD):
+    """
+    Returns the contents of ``file`` (a real, open file) as a string, or as a
+    MappedBody if it is larger than ``threshold`` bytes.
+    """
+    size = os.fstat(file.fileno()).st_size
+    if threshold is not None and size > threshold:
+        return MappedBody(file)
+    try:
+        return file.read()
+    finally:
+        file.close()
+
 class DigitalObjectFile(object):
-    def __init__(self, digital_object=None, url=None, filename=None, mimetype=None, body=None, size=None):
+    """
+    An element of a digital object. The element of a file that is stored once for
+    several objects holds no body but the URL of the element that does (``reference``);
+    ``url`` is where the body is read from.
+    """
+    def __init__(self, digital_object=None, url=None, filename=None, mimetype=None, body=None, size=None, reference=None):
         self.digital_object = digital_object
         self.url = url
+        self.reference = reference or None
+        if reference:
+            self.url = reference
+            size = None # the element's own size, which is 0
         if filename:
             self.filename = filename
         if mimetype:
@@ -333,7 +1020,10 @@ class DigitalObjectFile(object):
         return "<DigitalObjectFile %s (%s)>" % (name, self.mimetype)
     
     def open(self):
-        return StringIO(self.body)
+        body = self.load()
+        if isinstance(body, MappedBody):
+            return body.open()
+        return StringIO(body)
     
     def save(self, file):
         """
@@ -345,31 +1035,180 @@ class DigitalObjectFile(object):
             file = open(file, 'w')
         except TypeError:
             pass
-        file.write(self.body)
+        body = self.load()
+        if isinstance(body, MappedBody):
+            body.save(file)
+        else:
+            file.write(body)
         file.close()
     
+    def download(self):
+        """
+        Returns the body, downloading it if it hasn't been loaded, without keeping it.
+        Bodies larger than ``settings.SPOOL_THRESHOLD`` are spooled to a temporary file
+        and returned as a MappedBody; smaller ones as a string.
+        """
+        if hasattr(self, '_body'):
+            return self._body
+        opener = get_opener()
+        opener.get(self.url)
+        return spool(opener.read)
+
+    def fetch(self):
+        """
+        Returns the body as a string, downloading it if it hasn't been loaded, without keeping it.
+        """
+        return str(self.download())
+
+    def load(self):
+        """
+        Returns the body as a string or MappedBody (see ``download``), keeping it unless
+        ``settings.KEEP_FILE_BODIES`` is False.
+        """
+        body = self.download()
+        if KEEP_FILE_BODIES:
+            self._body = body
+        return body
+
+    def fetch_range(self, start, end):
+        """
+        Returns bytes ``start`` to ``end`` (both included) of the body. Unless the body
+        is loaded already only those bytes are asked for, with a ranged GET.
+        """
+        if hasattr(self, '_body'):
+            return self._body[start:end + 1]
+        opener = get_opener()
+        opener.get(self.url, headers={'Range': 'bytes=%d-%d' % (start, end)})
+        body = opener.read()
+        if opener.response.getcode() != 206: # the repository sent the whole body
+            body = body[start:end + 1]
+        return body
+
     @property
     def body(self):
-        if not hasattr(self, '_body'):
-            opener.get(self.url)
-            self._body = opener.read()
-        return self._body
+        """
+        The body as a string. Large bodies are spooled to a file as they are downloaded;
+        ``open`` and ``save`` read those without building the string.
+        """
+        return str(self.load())
 
     @body.setter
     def body(self, body):
         self._body = body
 
+    def release(self):
+        """
+        Drops the body if it is loaded; it will be downloaded again when it is needed.
+        """
+        self.__dict__.pop('_body', None)
+
 class NoDefault(object):
     """ This is a placer object so that if someone specifies a default, 
     even None, it will work
     """
     pass
 
+class LRUCache(object):
+    """
+    A mapping which holds at most ``size`` items (any number if ``size`` is None),
+    dropping the least recently used ones first.
+
+    Items are kept in two generations of up to ``size / 2`` items each. New items go
+    into the current generation and items read from the previous one move back into
+    it; when the current generation is full it becomes the previous one, and what was
+    in the previous one is dropped. This approximates LRU while keeping reads as cheap
+    as a dict lookup, and needs no locking to be shared between threads.
+
+    >>> cache = LRUCache(4)
+    >>> cache['a'] = 1
+    >>> cache['b'] = 2
+    >>> cache.get('a')
+    1
+    >>> cache['c'] = 3
+    >>> sorted(cache.keys())
+    ['a', 'c']
+    """
+    def __init__(self, size=None):
+        self.size = size
+        self.generation_size = max(size // 2, 1) if size is not None else None
+        self.current = {}
+        self.previous = {}
+
+    def get(self, key, default=None):
+        value = self.current.get(key, NoDefault)
+        if value is NoDefault:
+            value = self.previous.pop(key, NoDefault)
+            if value is NoDefault:
+                return default
+            self[key] = value
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key, NoDefault)
+        if value is NoDefault:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.current[key] = value
+        if self.generation_size is not None and len(self.current) >= self.generation_size:
+            self.previous, self.current = self.current, {}
+
+    def __delitem__(self, key):
+        if self.current.pop(key, NoDefault) is NoDefault and self.previous.pop(key, NoDefault) is NoDefault:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.current or key in self.previous
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        return list(set(self.previous) | set(self.current))
+
+    def values(self):
+        values = dict(self.previous)
+        values.update(self.current)
+        return values.values()
+
+    def clear(self):
+        self.current, self.previous = {}, {}
+
+class ObjectRecord(object):
+    """
+    What a search says about a digital object: its handle, URL, dates, attributes and
+    the details of its files, but no file body. Lists of search results hold these and
+    build a DigitalObject from one when it is asked for, so that the objects (and the
+    bodies loaded through them) dropped from a list's cache can be freed.
+    """
+    __slots__ = ('handle', 'url', 'created', 'modified', 'attributes', 'files')
+
+    def __init__(self, handle=None, url=None, created=None, modified=None, attributes=None, files=None):
+        self.handle = handle
+        self.url = url
+        self.created = created
+        self.modified = modified
+        self.attributes = attributes or {}
+        self.files = files or {}
+
+    def __str__(self):
+        return self.handle
+
+    def digital_object(self, repository):
+        return DigitalObject(repository=repository, handle=self.handle, url=self.url, created=self.created,
+                             modified=self.modified, attributes=dict(self.attributes), files=self.files)
+
 class DigitalObjectList(object):
-    def __init__(self, objects, repository):
+    """
+    The objects of a listing or search, given as handles (looked up when they are
+    needed), ObjectRecords or DigitalObjects. At most ``cache_size`` of the objects
+    built from handles or records are kept.
+    """
+    def __init__(self, objects, repository, cache_size=OBJECT_CACHE_SIZE):
         self.repository = repository
         self.object_handles=objects
-        self.objects = {}
+        self.objects = LRUCache(cache_size)
         self.index = 0
     
     def __len__(self):
@@ -384,10 +1223,14 @@ class DigitalObjectList(object):
     def get_object(self, handle):
         if isinstance(handle, DigitalObject):
             return handle
-        obj = self.objects.get(handle, None)
-        if not obj:
-            obj = self.repository.get(handle)
-            self.objects[handle] = obj
+        key = handle.handle if isinstance(handle, ObjectRecord) else handle
+        obj = self.objects.get(key, None)
+        if obj is None:
+            if isinstance(handle, ObjectRecord):
+                obj = handle.digital_object(self.repository)
+            else:
+                obj = self.repository.get(handle)
+            self.objects[key] = obj
         return obj
     
     def __getitem__(self, index):
@@ -403,13 +1246,79 @@ class DigitalObjectList(object):
 
 
 
+class AttributeBatch(object):
+    """
+    Collects the attribute changes made to a DigitalObject (``with digital_object.batch():``)
+    and writes them to the repository when the block ends: only the last value set for
+    each attribute, all attributes at the same time. Until then the new values are only
+    seen locally. If the block raises an exception nothing is written and the attributes
+    are put back as they were; if a write fails, that attribute is put back and the error
+    raised once the other writes are done. Nested batches are written by the outermost.
+
+    >>> do = DigitalObject(handle='1234/5', url='http://localhost/do/1234%2F5/', attributes={'name': 'Circle'})
+    >>> with do.batch():
+    ...     do.set('name', 'Square')
+    ...     do.set('name', 'Round')
+    ...     raise ValueError("no thanks")
+    Traceback (most recent call last):
+        ...
+    ValueError: no thanks
+    >>> do.get('name'), do.batch_changes
+    ('Circle', None)
+    """
+    def __init__(self, digital_object):
+        self.digital_object = digital_object
+        self.outermost = False
+
+    def __enter__(self):
+        digital_object = self.digital_object
+        if digital_object.batch_changes is None:
+            self.outermost = True
+            self.original = dict(digital_object.attributes)
+            digital_object.batch_changes = collections.OrderedDict()
+        return digital_object
+
+    def restore(self, name):
+        if name in self.original:
+            self.digital_object.attributes[name] = self.original[name]
+        else:
+            self.digital_object.attributes.pop(name, None)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.outermost:
+            return
+        digital_object = self.digital_object
+        changes, digital_object.batch_changes = digital_object.batch_changes, None
+        if exc_type is not None:
+            for name in changes:
+                self.restore(name)
+            return
+        if not changes:
+            return
+
+        def write((name, value)):
+            try:
+                digital_object.put_attribute(name, value)
+            except Exception:
+                self.restore(name)
+                raise
+
+        try:
+            parallel_map(write, changes.items())
+        finally:
+            if digital_object.repository:
+                digital_object.repository.object_changed(digital_object)
+
 class DigitalObject(object):
-    def __init__(self, repository=None, url=None, handle=None, created=None, files=[], attributes={}):
+    batch_changes = None
+
+    def __init__(self, repository=None, url=None, handle=None, created=None, modified=None, files=[], attributes={}):
         self.repository = repository
         self.url = url
         self.attributes = attributes
         self.handle = handle
         self.created = created
+        self.modified = modified or created
         self.files = {}
         if files:
             for file_key, file_obj in files.items():
@@ -446,48 +1355,261 @@ class DigitalObject(object):
                 return default
             raise AttributeError("'%(obj_type)s' has no attribute '%(name)s'. It does have %(what)s" % { 'obj_type': type(self).__name__, 'name': name, 'what': repr(self.__dict__) })
 
+    def put_attribute(self, name, value):
+        get_opener().put('%(url)satt/%(name)s/' % {'url': self.url, 'handle': escape_for_url(self.handle), 'name': escape_for_url(name)}, body=value)
+
     def set(self, name, value):
-        opener.put('%(url)satt/%(name)s/' % {'url': self.url, 'handle': escape_for_url(self.handle), 'name': escape_for_url(name)}, body=value)
+        if self.batch_changes is not None:
+            self.batch_changes[name] = value
+            self.attributes[name] = value
+            return
+        self.put_attribute(name, value)
         self.attributes[name]=value
+        if self.repository:
+            self.repository.object_changed(self)
+
+    def batch(self):
+        """
+        Returns a context in which attribute changes are collected and written together
+        when it ends; see AttributeBatch.
+        """
+        return AttributeBatch(self)
 
     def get_file(self, name):
         return self.files[name].open()
     
-    def put_file(self, name, file):
+    def put_file(self, name, file, share=True):
+        """
+        Stores ``file`` as the element ``name``. Its body isn't sent if the element holds
+        the same content already, or, with ``share``, if another object's element ``name``
+        holds it (see ``DigitalObjectRepository.stored_element``), in which case the
+        element refers to that one. If other objects refer to the body being replaced it
+        is first moved to a blob and they are pointed at it.
+        """
         file = get_file_container(file)
-        file_url = '%sel/%s/' % (self.url, name)
-        opener.put_file(file_url, file)
+        file_url = self.element_url(name)
+        hash_attribute = '%s_sha1' % name
+        sha1 = content_hash(file['body'])
+        previous = self.files.get(name)
+        opener = get_opener()
+        if previous and self.get(hash_attribute, None) == sha1:
+            reference = previous.reference
+        else:
+            if previous:
+                self.release_file(name)
+            reference = share and self.repository and self.repository.stored_element(name, sha1, len(file['body']))
+            if reference:
+                opener.put_file(file_url, {'body': ''})
+                opener.put('%sel/%s/att/reference' % (self.url, name), body=reference)
+            else:
+                opener.put_file(file_url, file)
+                if previous and previous.reference:
+                    opener.put('%sel/%s/att/reference' % (self.url, name), body='')
         opener.put('%sel/%s/att/mimetype' % (self.url, name), body=file.get('mimetype', guess_type(file['filename'])) )
         opener.put('%sel/%s/att/filename' % (self.url, name), body=file['filename'] )
         file['url'] = file_url
-        self.files[name] = DigitalObjectFile(**file)
-        
-    def delete(self):
-        opener.delete(self.url)
+        self.files[name] = DigitalObjectFile(reference=reference, **file)
+        if self.get(hash_attribute, None) != sha1:
+            self.set(hash_attribute, sha1)
+        if self.repository:
+            self.repository.object_changed(self)
+
+    def element_url(self, name):
+        return '%sel/%s/' % (self.url, name)
+
+    def referrers(self, name):
+        """
+        Returns the other objects whose element ``name`` refers to this object's.
+        """
+        sha1 = self.get('%s_sha1' % name, None)
+        do_file = self.files.get(name)
+        if not sha1 or not self.repository or do_file is None or do_file.reference:
+            return []
+        url = self.element_url(name)
+        return [digital_object for digital_object in self.repository.search('objatt_%s_sha1:%s' % (name, sha1))
+                if digital_object.handle != self.handle and name in digital_object.files
+                and same_element(digital_object.files[name].reference, url)]
+
+    def release_file(self, name):
+        """
+        Lets go of the body of the element ``name`` before it is replaced or the object
+        deleted. If the element refers to a blob nothing else refers to any more, the blob
+        is deleted; if it holds a body others refer to, the body is moved to a new blob
+        and they are pointed at it. The element locations and bodies cached for those
+        objects are then those of the blob, so nothing read through them changes.
+        """
+        do_file = self.files.get(name)
+        if do_file is None or not self.repository:
+            return
+        if do_file.reference:
+            holder = self.repository.element_holder(name, self.get('%s_sha1' % name, None), do_file.reference)
+            if holder is not None and holder.get('type', None) == BLOB_TYPE:
+                holder.delete(releasing=self.handle)
+            return
+        referrers = self.referrers(name)
+        if not referrers:
+            return
+        sha1 = self.get('%s_sha1' % name)
+        blob = self.repository.create(data={'type': BLOB_TYPE}, key=sha1)
+        blob.put_file(name, {'filename': do_file.filename, 'mimetype': do_file.mimetype, 'body': do_file.body}, share=False)
+        url = blob.element_url(name)
+        opener = get_opener()
+        for digital_object in referrers:
+            opener.put('%sel/%s/att/reference' % (digital_object.url, name), body=url)
+            old = digital_object.files[name]
+            digital_object.files[name] = DigitalObjectFile(url=digital_object.element_url(name), filename=old.filename,
+                                                           mimetype=old.mimetype, reference=url)
+            self.repository.object_changed(digital_object)
+
+    def referenced(self, releasing=None):
+        """
+        Whether other objects than ``releasing`` (a handle) refer to one of its files.
+        """
+        return any(digital_object.handle != releasing for name in self.files for digital_object in self.referrers(name))
+
+    def delete(self, releasing=None):
+        """
+        Deletes the object, or, while other objects (than ``releasing``, about to let go
+        of it) refer to one of its files, only takes it out of sight by making it a blob,
+        deleted with the last of them.
+        """
+        if self.referenced(releasing):
+            if self.get('type', None) != BLOB_TYPE:
+                self.set('type', BLOB_TYPE)
+        else:
+            get_opener().delete(self.url)
+            for name, do_file in self.files.items():
+                if do_file.reference:
+                    self.release_file(name)
+        if self.repository:
+            self.repository.object_deleted(self)
 
 
 
 class DigitalObjectRepository(object):
-    
-    def __init__(self, url):
-        self.url=url
-    
+    """
+    The DO Repository at ``url``, or spread over several servers if ``url`` is a list of
+    shards (see the top of this module). The shard of each object seen in a listing or
+    search is remembered, so getting it by its handle goes straight to that shard;
+    other handles are looked for on every shard at once.
+    """
+    def __init__(self, url, virtual_nodes=SHARD_VIRTUAL_NODES):
+        shards = url if isinstance(url, (list, tuple)) else [url]
+        self.shards = [ReplicaSet(list(shard) if isinstance(shard, (list, tuple)) else [shard]) for shard in shards]
+        self.url = self.shards[0].url
+        if len(self.shards) > 1 or len(self.shards[0].replicas) > 1:
+            opener = get_opener()
+            for shard in self.shards:
+                opener.add_replica_set(shard)
+        self.ring = HashRing([shard.url for shard in self.shards], virtual_nodes)
+        self.locations = LRUCache(LOCATION_CACHE_SIZE)
+
+    @property
+    def sharded(self):
+        return len(self.shards) > 1
+
     def requests(self):
-        return opener.requests
-    
+        return get_opener().requests
+
+    def check_health(self):
+        """
+        Probe the replicas of every replicated shard (see ``ReplicaSet.check_health``).
+        """
+        for shard in self.shards:
+            if len(shard.replicas) > 1:
+                shard.check_health()
+
+    def fan_out(self, function):
+        """
+        Calls ``function`` with the URL of each shard, all at once, and returns the results.
+        """
+        return parallel_map(function, [shard.url for shard in self.shards])
+
+    def search_shard(self, url, query):
+        opener = get_opener()
+        opener.get(url + '?query=%s' % escape_for_url(query))
+        object_list = parse_objects(opener.read(), url)
+        if self.sharded:
+            for o in object_list:
+                self.locations[o['handle']] = url
+        return [ObjectRecord(**o) for o in object_list]
+
     def search(self, query=''):
-        search_url = self.url + '?query=%s' % escape_for_url(query)
-        opener.get(search_url)
-        object_list = parse_objects(opener.read(), self.url)
-        return DigitalObjectList(objects=[DigitalObject(**o) for o in object_list], repository=self)
-            
+        if not self.sharded:
+            return DigitalObjectList(objects=self.search_shard(self.url, query), repository=self)
+        objects = []
+        seen = set()
+        for result in self.fan_out(lambda url: self.search_shard(url, query)):
+            for digital_object in result:
+                if digital_object.handle not in seen:
+                    seen.add(digital_object.handle)
+                    objects.append(digital_object)
+        objects.sort(key=lambda digital_object: (digital_object.created is None, digital_object.created, digital_object.handle))
+        return DigitalObjectList(objects=objects, repository=self)
+
+    def list_shard(self, url):
+        opener = get_opener()
+        opener.get(url)
+        handles = [o['handle'] for o in parse_objects(opener.read(), url)]
+        if self.sharded:
+            for handle in handles:
+                self.locations[handle] = url
+        return handles
+
     def all(self):
-        opener.get(self.url)
-        object_list = parse_objects(opener.read(), self.url)
-        return DigitalObjectList(objects=[o['handle'] for o in object_list], repository=self)
+        handles = []
+        seen = set()
+        for result in self.fan_out(self.list_shard):
+            for handle in result:
+                if handle not in seen:
+                    seen.add(handle)
+                    handles.append(handle)
+        return DigitalObjectList(objects=handles, repository=self)
     
+    def changed_since(self, timestamp, query=''):
+        """
+        Returns the objects matching ``query`` that were created or modified at or
+        after ``timestamp`` (a datetime).
+        """
+        since = int(time.mktime(timestamp.timetuple())) * 1000
+        changed = '%s:[%013d TO 9999999999999]' % (MODIFIED_ATTRIBUTE, since)
+        if query:
+            changed = '(%s) AND %s' % (query, changed)
+        return self.search(changed)
+
     def get(self, handle=None):
-        url = '%s%s/' % (self.url, escape_for_url(handle))
+        if not self.sharded:
+            return self.get_from(self.url, handle)
+        known = self.locations.get(handle)
+        if known:
+            try:
+                return self.get_from(known, handle)
+            except DigitalObjectNotFound:
+                del self.locations[handle]
+
+        # a shard that fails doesn't fail the lookup if another one has the object
+        def look_up(url):
+            try:
+                return url, self.get_from(url, handle), None
+            except DigitalObjectNotFound:
+                return url, None, None
+            except Exception, inst:
+                return url, None, inst
+
+        errors = []
+        for url, digital_object, error in self.fan_out(look_up):
+            if digital_object is not None:
+                self.locations[handle] = url
+                return digital_object
+            if error is not None:
+                errors.append(error)
+        if errors:
+            raise errors[0]
+        raise DigitalObjectNotFound("Digital object %s not found in repository." % handle)
+
+    def get_from(self, base_url, handle):
+        url = '%s%s/' % (base_url, escape_for_url(handle))
+        opener = get_opener()
         try:
             opener.get(url)
         except urllib2.HTTPError, inst:
@@ -499,26 +1621,129 @@ class DigitalObjectRepository(object):
                 raise
         except urllib2.URLError, inst:
                 raise DORepositoryServerError(inst.reason)
-        objdata = parse_object(opener.read(), url=self.url)
+        objdata = parse_object(opener.read(), url=base_url)
         do_files = {}
         for k, v in objdata['files'].items():
-            do_files[k] = DigitalObjectFile(url=v['url'], filename=v.get('filename', None), mimetype=v.get('mimetype', None), size=v.get('size', None))
+            do_files[k] = DigitalObjectFile(url=v['url'], filename=v.get('filename', None), mimetype=v.get('mimetype', None), size=v.get('size', None), reference=v.get('reference', None))
         objdata['files'] = do_files
         obj = DigitalObject(repository=self, **objdata)
         return obj
     
-    def create(self, files={}, data={}):
-        opener.post(self.url)
-        objdata = parse_object(opener.read(), url=self.url)
+    def create(self, files={}, data={}, key=None):
+        """
+        Creates an object with ``files`` and the attributes in ``data``. On a sharded
+        repository it goes to the shard ``key`` hashes to; objects created with the same
+        key end up together, and without a key the objects are spread evenly.
+        """
+        url = self.url
+        if self.sharded:
+            url = self.ring.node(key if key is not None else uuid.uuid4().hex)
+        opener = get_opener()
+        opener.post(url)
+        objdata = parse_object(opener.read(), url=url)
+        if self.sharded:
+            self.locations[objdata['handle']] = url
         obj = DigitalObject(repository=self, **objdata)
-        for k, v in files.items():
-            obj.put_file(k, v)
-        for k, v in data.items():
-            obj.set(k, v)
+        with obj.batch():
+            for k, v in files.items():
+                obj.put_file(k, v)
+            for k, v in data.items():
+                obj.set(k, v)
         return obj
 
+    def stored_element(self, name, sha1, size):
+        """
+        Returns the URL of an element ``name`` holding a body of ``size`` bytes whose
+        SHA-1 is ``sha1``, for an element to refer to instead of storing the body again,
+        or None if the body should be uploaded. Bodies smaller than
+        ``settings.DEDUP_MIN_SIZE`` bytes, for which the search would cost about as much
+        as the upload, are always uploaded.
+
+        Two uploads of the same new content at the same time both store it, which only
+        costs the space; an upload that finds a blob just as its last referrer deletes it
+        is left referring to nothing, which ``collect_blobs`` doesn't undo.
+        """
+        if DEDUP_MIN_SIZE is None or size < DEDUP_MIN_SIZE:
+            return None
+        hash_attribute = '%s_sha1' % name
+        for digital_object in self.search('objatt_%s:%s' % (hash_attribute, sha1)):
+            if digital_object.get(hash_attribute, None) == sha1 and name in digital_object.files:
+                return digital_object.files[name].url
+        return None
+
+    def element_holder(self, name, sha1, url):
+        """
+        Returns the object whose element ``name``, of content ``sha1``, is at ``url``, or
+        None if it's gone.
+        """
+        for digital_object in self.search('objatt_%s_sha1:%s' % (name, sha1)):
+            do_file = digital_object.files.get(name)
+            if do_file is not None and not do_file.reference and same_element(do_file.url, url):
+                return digital_object
+        return None
+
+    def collect_blobs(self):
+        """
+        Deletes the blobs nothing refers to any more, left behind when the deletion of
+        their last referrer was interrupted, and returns how many there were.
+        """
+        collected = 0
+        for blob in self.search('objatt_type:%s' % BLOB_TYPE):
+            if not blob.referenced():
+                blob.delete()
+                collected += 1
+        return collected
+
+    def object_changed(self, digital_object):
+        """
+        Called after an attribute or file of one of this repository's objects is changed.
+        Subclasses which keep a local copy of repository data override this.
+        """
+        pass
+
+    def object_deleted(self, digital_object):
+        """
+        Called after one of this repository's objects is deleted.
+        """
+        pass
+
+
+def new_breaker():
+    """
+    A CircuitBreaker configured from settings, or None if breaking circuits is turned off.
+    """
+    if getattr(settings, 'DO_BREAKER_THRESHOLD', 5):
+        return CircuitBreaker(getattr(settings, 'DO_BREAKER_THRESHOLD', 5), getattr(settings, 'DO_BREAKER_RESET', 30.0))
+    return None
+
+_opener = None
+def get_opener():
+    """
+    Returns the shared ``AuthorizedOpener``, creating it from settings on first use.
+    """
+    global _opener
+    if _opener is None:
+        _opener = AuthorizedOpener(settings.DO_USER, settings.DO_PASSWORD,
+                                   timeout=getattr(settings, 'DO_TIMEOUT', 10.0),
+                                   retries=getattr(settings, 'DO_RETRIES', 2),
+                                   backoff=getattr(settings, 'DO_RETRY_BACKOFF', 0.1),
+                                   hedge_percentile=getattr(settings, 'DO_HEDGE_PERCENTILE', None),
+                                   breaker=new_breaker())
+    return _opener
+
+class OpenerProxy(object):
+    """
+    Stands for the shared ``AuthorizedOpener`` (see ``get_opener``) without creating it
+    until one of its attributes is used, as the module's ``opener`` did before the
+    opener was created on first use.
+    """
+    def __getattr__(self, name):
+        return getattr(get_opener(), name)
+
+    def __setattr__(self, name, value):
+        setattr(get_opener(), name, value)
 
-opener = AuthorizedOpener(settings.DO_USER, settings.DO_PASSWORD)
+opener = OpenerProxy() # kept for code written against it; new code calls get_opener()
 
 if __name__ == "__main__":
     import doctest
@@ -0,0 +1,209 @@
+"""
+Exports shapes as a zip or tar archive, written to a stream as it is built.
+
+An archive holds a ``manifest.json`` describing every shape (as in the JSON listing,
+plus the handles of its categories and the paths of its file and mask in the archive)
+followed by the files and masks themselves, under ``shapes/<handle>/file/`` and
+``shapes/<handle>/mask/``. The files are downloaded from several threads at once and
+added to the archive in the order the downloads finish; only a few of them are held
+in memory at any time, so the size of a library doesn't matter.
+
+Export a category with ``export(category.children, stream)`` or the whole library
+with ``export(shape_repository.all(), stream)``. The stream only needs a ``write``
+method, so it can be a socket or an HTTP response.
+
+>>> from StringIO import StringIO
+>>> from dorepository import DigitalObject
+>>> import zipfile
+>>> shape = shapes.Shape(digital_object=DigitalObject(handle='1234/5', url='http://localhost/do/1234%2F5/',
+...     attributes={'name': 'Circle', 'type': 'shape'},
+...     files={'content': {'url': 'http://localhost/do/1234%2F5/el/content', 'filename': 'circle.svg', 'body': '<svg />'}}), repository=None)
+>>> stream = StringIO()
+>>> export([shape], stream)
+>>> archive = zipfile.ZipFile(StringIO(stream.getvalue()))
+>>> archive.namelist()
+['manifest.json', 'shapes/1234%2F5/file/circle.svg']
+>>> archive.read('shapes/1234%2F5/file/circle.svg')
+'<svg />'
+"""
+import zipfile, tarfile, time, threading, Queue, sys, os, re, mimetypes
+from StringIO import StringIO
+
+from dorepository import escape_for_url, current_deadline, NONSTANDARD_MIME_TYPES
+import settings, shapes, render
+
+EXPORT_WORKERS = getattr(settings, 'EXPORT_WORKERS', 4)
+
+FORMATS = {
+    'zip': 'application/zip',
+    'tar': 'application/x-tar',
+}
+
+class PositionTracker(object):
+    """
+    Wraps a stream that can only be written to, keeping track of the position for
+    ``zipfile``, which asks for it (but never seeks when entries are written whole).
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.position = 0
+
+    def write(self, data):
+        self.stream.write(data)
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        if hasattr(self.stream, 'flush'):
+            self.stream.flush()
+
+class ZipArchive(object):
+    def __init__(self, stream):
+        self.zip = zipfile.ZipFile(PositionTracker(stream), 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+
+    def add(self, path, body, mtime):
+        info = zipfile.ZipInfo(path, time.localtime(max(mtime, 315532800))[:6]) # zip dates start in 1980
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = 0644 << 16
+        self.zip.writestr(info, body)
+
+    def close(self):
+        self.zip.close()
+
+class TarArchive(object):
+    def __init__(self, stream):
+        self.tar = tarfile.open(fileobj=stream, mode='w|')
+
+    def add(self, path, body, mtime):
+        info = tarfile.TarInfo(path)
+        info.size = len(body)
+        info.mtime = mtime
+        info.mode = 0644
+        self.tar.addfile(info, StringIO(body))
+
+    def close(self):
+        self.tar.close()
+
+ARCHIVES = {
+    'zip': ZipArchive,
+    'tar': TarArchive,
+}
+
+def to_mtime(value):
+    if value is None:
+        return time.time()
+    return time.mktime(value.timetuple())
+
+unsafe_characters = re.compile(r'[^\w.-]+')
+
+def archive_name(filename, label, mimetype):
+    """
+    The name of a file or mask (``label``) in the archive: the last part of the name it
+    was uploaded with, reduced to letters, digits, dots, dashes and underscores, or
+    ``<label>.<extension>`` if nothing usable is left. Uploaded names are chosen by
+    clients and must never lead out of the shape's directory when the archive is
+    extracted.
+
+    >>> archive_name('../../etc/x.svg', 'file', 'image/svg+xml')
+    'x.svg'
+    >>> archive_name('..', 'mask', 'image/svg+xml')
+    'mask.svg'
+    >>> archive_name('C:\\shapes\\my circle.svg', 'file', 'image/svg+xml')
+    'my_circle.svg'
+    """
+    name = os.path.basename((filename or '').replace('\\', '/'))
+    name = unsafe_characters.sub('_', name).strip('_')
+    if name.strip('.') == '':
+        extensions = dict((value, key) for key, value in NONSTANDARD_MIME_TYPES.items())
+        extension = extensions.get(mimetype) or (mimetypes.guess_extension(mimetype or '') or '.bin').lstrip('.')
+        name = '%s.%s' % (label, extension)
+    return name
+
+def archive_entries(shape_list):
+    """
+    Returns the manifest of ``shape_list`` and a list of (path, shape file, mtime) tuples
+    for the files and masks to put in the archive; no file is downloaded yet.
+    """
+    manifest = []
+    entries = []
+    for shape in shape_list:
+        data = shape.data(False)
+        data['categories'] = [handle for handle in shape.digital_object.get('category', '').split(',') if handle]
+        for key, shape_file in (('file', shape.file), ('mask', shape.mask)):
+            data[key] = None
+            if shape_file:
+                data[key] = 'shapes/%s/%s/%s' % (escape_for_url(shape.handle), key,
+                                                 archive_name(shape_file.do_file.filename, key, shape_file.do_file.mimetype))
+                entries.append((data[key], shape_file, to_mtime(shape.digital_object.modified)))
+        manifest.append(data)
+    return manifest, entries
+
+def fetch_elements(entries, max_workers=EXPORT_WORKERS):
+    """
+    Downloads the files of ``entries`` from up to ``max_workers`` threads and yields
+    (path, body, mtime) tuples in the order the downloads finish. Downloads wait while
+    ``max_workers`` bodies are already waiting to be consumed. The current deadline
+    applies in the download threads.
+    """
+    tasks = Queue.Queue()
+    for entry in entries:
+        tasks.put(entry)
+    results = Queue.Queue(max_workers)
+    stopped = threading.Event()
+    deadline = current_deadline()
+
+    def work():
+        if deadline:
+            deadline.__enter__()
+        try:
+            while not stopped.is_set():
+                try:
+                    path, shape_file, mtime = tasks.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    result = (path, shape_file.do_file.fetch(), mtime), None
+                except Exception:
+                    result = None, sys.exc_info()
+                while not stopped.is_set():
+                    try:
+                        results.put(result, timeout=0.1)
+                        break
+                    except Queue.Full:
+                        pass
+        finally:
+            if deadline:
+                deadline.__exit__()
+
+    threads = [threading.Thread(target=work) for _ in range(min(max_workers, len(entries)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for _ in range(len(entries)):
+            element, exc_info = results.get()
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            yield element
+    finally:
+        stopped.set()
+        for thread in threads:
+            thread.join()
+
+def export(shape_list, stream, format='zip', max_workers=EXPORT_WORKERS):
+    """
+    Writes an archive (``format`` is 'zip' or 'tar') of the shapes in ``shape_list``,
+    with their files, masks and a manifest, to ``stream``.
+    """
+    manifest, entries = archive_entries(shape_list)
+    archive = ARCHIVES[format](stream)
+    archive.add('manifest.json', render.to_json(manifest), time.time())
+    for path, body, mtime in fetch_elements(entries, max_workers):
+        archive.add(path, body, mtime)
+    archive.close()
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
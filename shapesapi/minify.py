@@ -0,0 +1,81 @@
+"""
+Lossless minification of SVG documents, applied to shape files and masks as they are
+uploaded so that every later download is smaller.
+
+Only what doesn't change how the document is read is removed: comments, whitespace
+between elements and the extra whitespace inside tags. Whitespace between elements
+is kept inside elements where it can be significant (text, styles, scripts and the
+like, and anything under ``xml:space="preserve"``), attribute values, character
+data and the XML declaration are left as they are, and so are numbers and paths.
+Documents that don't look like uncompressed, 8-bit encoded XML are returned unchanged.
+
+>>> print minify_svg('''<?xml version="1.0"?>
+... <!-- drawn by hand -->
+... <svg  xmlns="http://www.w3.org/2000/svg"
+...       viewBox="0 0 100 100">
+...   <circle r="40.000"  fill='red' />
+...   <text x="10"> <tspan>Hello</tspan> <tspan>world</tspan> </text>
+... </svg >
+... ''')
+<?xml version="1.0"?><svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 100 100"><circle r="40.000" fill='red'/><text x="10"> <tspan>Hello</tspan> <tspan>world</tspan> </text></svg>
+"""
+import re
+
+PRESERVING_ELEMENTS = frozenset(['text', 'tspan', 'textPath', 'tref', 'altGlyph', 'style', 'script',
+                                 'title', 'desc', 'metadata', 'foreignObject', 'pre'])
+
+tokens = re.compile(r'''<!--.*?-->|<!\[CDATA\[.*?\]\]>|<\?.*?\?>|<!(?:[^\[>]|\[.*?\])*>|<(?:[^>"']|"[^"]*"|'[^']*')*>|[^<]+''', re.S).finditer
+start_tag = re.compile(r'''<([^\s/>]+)((?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|'[^']*'))*)\s*(/?)>$''')
+attributes = re.compile(r'''([^\s=]+)\s*=\s*("[^"]*"|'[^']*')''').findall
+end_tag = re.compile(r'</([^\s>]+)\s*>$')
+
+def local_name(name):
+    return name.rpartition(':')[2]
+
+def minify_svg(body):
+    """
+    Returns ``body``, an SVG document, without comments and insignificant whitespace;
+    ``body`` itself if there is nothing to remove or it can't be minified safely.
+    """
+    if body[:2] in ('\x1f\x8b', '\xff\xfe', '\xfe\xff'): # compressed (.svgz) or UTF-16
+        return body
+    parts = []
+    stack = [] # (local name, whether whitespace between elements is kept) of the open elements
+    for match in tokens(body):
+        token = match.group()
+        preserving = stack and stack[-1][1]
+        if token.startswith('<!--'):
+            continue
+        if not token.startswith('<'):
+            if preserving or token.strip():
+                parts.append(token)
+            continue
+        if token.startswith('<!') or token.startswith('<?'):
+            parts.append(token)
+            continue
+        tag = start_tag.match(token)
+        if tag:
+            name, attribute_text, empty = tag.groups()
+            pairs = attributes(attribute_text)
+            parts.append('<%s%s%s>' % (name, ''.join(' %s=%s' % pair for pair in pairs), empty))
+            if not empty:
+                space = dict(pairs).get('xml:space', '')[1:-1]
+                if space:
+                    preserving = space == 'preserve'
+                stack.append((local_name(name), preserving or local_name(name) in PRESERVING_ELEMENTS))
+            continue
+        tag = end_tag.match(token)
+        if tag:
+            parts.append('</%s>' % tag.group(1))
+            if stack and stack[-1][0] == local_name(tag.group(1)):
+                stack.pop()
+            continue
+        parts.append(token)
+    minified = ''.join(parts)
+    if len(minified) >= len(body):
+        return body
+    return minified
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
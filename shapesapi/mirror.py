@@ -0,0 +1,385 @@
+"""
+A local, searchable mirror of the shape and category records in the DO Repository.
+
+The mirror keeps the attributes and file details of every shape and category in an
+SQLite database, with a full text index over the name, creator and school. It answers
+the subset of the repository's query language that ``shapes.py`` generates, so that
+searches don't have to go to the repository's query engine at all.
+
+Use a ``MirroredRepository`` wherever you would use a ``DigitalObjectRepository``.
+Searches are answered from the mirror when it has been built and understands the
+query, and are passed on to the repository otherwise. Changes made through the
+repository's objects are written through to the mirror; changes made by anyone
+else are picked up by calling ``sync``, which only fetches the records modified
+since the last sync. Objects deleted by anyone else can only be told by listing the
+whole repository, so that is only done every ``settings.MIRROR_DELETION_CHECK_INTERVAL``
+seconds.
+
+>>> rep = MirroredRepository(settings.DO_URL, '/tmp/shapes-mirror.db')
+>>> rep.rebuild()
+>>> shapes = rep.search('objatt_type:shape AND (objatt_name:"Test Shape")')
+>>> changed, deleted = rep.sync()
+
+The query translation can be tried without a repository:
+
+>>> translate('objatt_type:shape AND (objatt_name:"Test Shape" OR objatt_creator:jordan)')
+('(objects.type = ? AND (objects.handle IN (SELECT handle FROM objects_fts WHERE name MATCH ?) OR objects.handle IN (SELECT handle FROM objects_fts WHERE creator MATCH ?)))', ['shape', '"Test Shape"', '"jordan"'])
+>>> translate('objatt_type:category AND (id:1234/5 OR objatt_name:Circles)')[1]
+['category', '1234/5', '"Circles"']
+>>> translate('objatt_name:Circles')
+Traceback (most recent call last):
+    ...
+UnsupportedQuery: Only searches restricted to shapes or categories are mirrored: objatt_name:Circles
+"""
+import os, re, json, time, datetime, threading, sqlite3
+
+import settings
+from dorepository import DigitalObjectRepository, ObjectRecord, DigitalObjectList, DORepositoryException
+
+DELETION_CHECK_INTERVAL = getattr(settings, 'MIRROR_DELETION_CHECK_INTERVAL', 3600)
+
+MIRRORED_TYPES = ('shape', 'category')
+MIRRORED_QUERY = " OR ".join("objatt_type:%s" % t for t in MIRRORED_TYPES)
+TEXT_FIELDS = {
+    'objatt_name': 'name',
+    'objatt_creator': 'creator',
+    'objatt_school': 'school',
+}
+EXACT_FIELDS = {
+    'id': 'handle',
+    'objatt_type': 'type',
+}
+
+# changed whenever what ``object_record`` stores changes, so older mirrors are rebuilt
+RECORD_VERSION = '2'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    handle TEXT PRIMARY KEY,
+    type TEXT,
+    created REAL,
+    record TEXT
+);
+CREATE INDEX IF NOT EXISTS objects_type ON objects (type);
+CREATE TABLE IF NOT EXISTS object_categories (
+    handle TEXT,
+    category TEXT
+);
+CREATE INDEX IF NOT EXISTS object_categories_category ON object_categories (category);
+CREATE INDEX IF NOT EXISTS object_categories_handle ON object_categories (handle);
+CREATE VIRTUAL TABLE IF NOT EXISTS objects_fts USING fts4 (handle, name, creator, school);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+class UnsupportedQuery(DORepositoryException):
+    pass
+
+TOKEN_RE = re.compile(r'\s*(\(|\)|[\w.]+:"[^"]*"|[^\s()]+)')
+
+def tokenize(query):
+    tokens = []
+    position = 0
+    query = query.strip()
+    while position < len(query):
+        match = TOKEN_RE.match(query, position)
+        if not match:
+            raise UnsupportedQuery("Can't parse query: %s" % query)
+        tokens.append(match.group(1))
+        position = match.end()
+    return tokens
+
+class QueryParser(object):
+    """
+    Parses the boolean subset of the repository's query language into a tree of
+    ('and', [...]), ('or', [...]), ('not', node) and ('term', field, value) tuples.
+    """
+    def __init__(self, query):
+        self.query = query
+        self.tokens = tokenize(query)
+        self.position = 0
+
+    def parse(self):
+        node = self.expression()
+        if self.peek() is not None:
+            raise UnsupportedQuery("Can't parse query: %s" % self.query)
+        return node
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def next(self):
+        token = self.peek()
+        if token is None:
+            raise UnsupportedQuery("Unexpected end of query: %s" % self.query)
+        self.position += 1
+        return token
+
+    def expression(self):
+        nodes = [self.conjunction()]
+        while self.peek() == 'OR':
+            self.next()
+            nodes.append(self.conjunction())
+        return nodes[0] if len(nodes) == 1 else ('or', nodes)
+
+    def conjunction(self):
+        nodes = [self.factor()]
+        while self.peek() == 'AND':
+            self.next()
+            nodes.append(self.factor())
+        return nodes[0] if len(nodes) == 1 else ('and', nodes)
+
+    def factor(self):
+        token = self.next()
+        if token == 'NOT':
+            return ('not', self.factor())
+        if token == '(':
+            node = self.expression()
+            if self.next() != ')':
+                raise UnsupportedQuery("Unbalanced parentheses in query: %s" % self.query)
+            return node
+        field, colon, value = token.partition(':')
+        value = value.strip('"')
+        if not colon or not value or '*' in value or '?' in value:
+            raise UnsupportedQuery("Unsupported search term %s" % token)
+        if field not in TEXT_FIELDS and field not in EXACT_FIELDS and field != 'objatt_category':
+            raise UnsupportedQuery("Field %s is not mirrored" % field)
+        return ('term', field, value)
+
+def compile_node(node, params):
+    kind = node[0]
+    if kind in ('and', 'or'):
+        return "(%s)" % (" %s " % kind.upper()).join(compile_node(n, params) for n in node[1])
+    if kind == 'not':
+        return "NOT %s" % compile_node(node[1], params)
+    field, value = node[1], node[2]
+    if field == 'objatt_category':
+        params.append(value)
+        return "objects.handle IN (SELECT handle FROM object_categories WHERE category = ?)"
+    if field in EXACT_FIELDS:
+        params.append(value)
+        return "objects.%s = ?" % EXACT_FIELDS[field]
+    params.append('"%s"' % value.replace('"', ''))
+    return "objects.handle IN (SELECT handle FROM objects_fts WHERE %s MATCH ?)" % TEXT_FIELDS[field]
+
+def restricted_to_mirrored_types(node):
+    conjuncts = node[1] if node[0] == 'and' else [node]
+    for n in conjuncts:
+        if n[0] == 'term' and n[1] == 'objatt_type' and n[2] in MIRRORED_TYPES:
+            return True
+    return False
+
+def translate(query):
+    """
+    Translates a repository query into an SQL condition on the mirror's ``objects`` table
+    and its parameters. Raises ``UnsupportedQuery`` if the mirror can't answer the query.
+    """
+    node = QueryParser(query).parse()
+    if not restricted_to_mirrored_types(node):
+        raise UnsupportedQuery("Only searches restricted to shapes or categories are mirrored: %s" % query)
+    params = []
+    return compile_node(node, params), params
+
+def to_timestamp(value):
+    return time.mktime(value.timetuple()) if value else None
+
+def from_timestamp(value):
+    return datetime.datetime.fromtimestamp(value) if value is not None else None
+
+def object_record(digital_object):
+    """
+    Returns the parts of a DigitalObject needed to recreate it, in a form that can be stored as JSON.
+    """
+    files = {}
+    for key, do_file in digital_object.files.items():
+        files[key] = {
+            'url': do_file.url,
+            'filename': do_file.filename,
+            'mimetype': do_file.mimetype,
+            'size': getattr(do_file, 'size', None),
+            'reference': do_file.reference,
+        }
+    return {
+        'handle': digital_object.handle,
+        'url': digital_object.url,
+        'created': to_timestamp(digital_object.created),
+        'modified': to_timestamp(digital_object.modified),
+        'attributes': digital_object.attributes,
+        'files': files,
+    }
+
+class Mirror(object):
+    """
+    The SQLite database holding the mirrored records. Each process (and thread) gets its
+    own connection, opened the first time it's needed.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    @property
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.executescript(SCHEMA)
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def get_meta(self, key, default=None):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    @property
+    def ready(self):
+        return self.get_meta('built') is not None and self.get_meta('record_version') == RECORD_VERSION
+
+    @property
+    def watermark(self):
+        """
+        The latest modification time of any mirrored record, as a datetime.
+        """
+        return from_timestamp(float(self.get_meta('watermark', 0)))
+
+    def _advance_watermark(self, digital_objects):
+        latest = float(self.get_meta('watermark', 0))
+        for digital_object in digital_objects:
+            latest = max(latest, to_timestamp(digital_object.modified) or 0)
+        self.set_meta('watermark', str(latest))
+
+    def handles(self):
+        return set(handle for (handle,) in self.connection.execute("SELECT handle FROM objects"))
+
+    def _store(self, digital_object):
+        connection = self.connection
+        handle = digital_object.handle
+        attributes = digital_object.attributes
+        record = object_record(digital_object)
+        self._remove(handle)
+        connection.execute("INSERT INTO objects (handle, type, created, record) VALUES (?, ?, ?, ?)",
+                           (handle, attributes.get('type'), record['created'], json.dumps(record)))
+        connection.execute("INSERT INTO objects_fts (handle, name, creator, school) VALUES (?, ?, ?, ?)",
+                           (handle, attributes.get('name'), attributes.get('creator'), attributes.get('school')))
+        for category in attributes.get('category', '').split(','):
+            if category:
+                connection.execute("INSERT INTO object_categories (handle, category) VALUES (?, ?)", (handle, category))
+
+    def _remove(self, handle):
+        for table in ('objects', 'objects_fts', 'object_categories'):
+            self.connection.execute("DELETE FROM %s WHERE handle = ?" % table, (handle,))
+
+    def store(self, digital_object):
+        with self.connection:
+            self._store(digital_object)
+
+    def remove(self, handle):
+        with self.connection:
+            self._remove(handle)
+
+    def replace_all(self, digital_objects):
+        connection = self.connection
+        with connection:
+            for table in ('objects', 'objects_fts', 'object_categories'):
+                connection.execute("DELETE FROM %s" % table)
+            self.set_meta('watermark', '0')
+            for digital_object in digital_objects:
+                self._store(digital_object)
+            self._advance_watermark(digital_objects)
+            self.set_meta('built', str(time.time()))
+            self.set_meta('record_version', RECORD_VERSION)
+
+    def apply(self, changed, deleted):
+        """
+        Store the ``changed`` objects and remove the ``deleted`` handles in one transaction.
+        """
+        with self.connection:
+            for digital_object in changed:
+                self._store(digital_object)
+            for handle in deleted:
+                self._remove(handle)
+            self._advance_watermark(changed)
+
+    def search(self, query):
+        """
+        Returns the records matching ``query``, oldest first.
+        """
+        condition, params = translate(query)
+        rows = self.connection.execute("SELECT record FROM objects WHERE %s ORDER BY created, handle" % condition, params)
+        records = []
+        for (record,) in rows:
+            record = json.loads(record)
+            record['created'] = from_timestamp(record['created'])
+            record['modified'] = from_timestamp(record.get('modified'))
+            records.append(record)
+        return records
+
+class MirroredRepository(DigitalObjectRepository):
+    """
+    A DigitalObjectRepository which answers searches from a local mirror when it can.
+    """
+    def __init__(self, url, path, deletion_check_interval=DELETION_CHECK_INTERVAL):
+        super(MirroredRepository, self).__init__(url)
+        self.mirror = Mirror(path)
+        self.deletion_check_interval = deletion_check_interval
+
+    def rebuild(self):
+        """
+        Replace the contents of the mirror with every shape and category in the repository.
+        """
+        self.mirror.replace_all(super(MirroredRepository, self).search(MIRRORED_QUERY))
+
+    def sync(self, check_deletions=None):
+        """
+        Bring the mirror up to date with the repository without a full rescan: the
+        records modified since the watermark are fetched and stored. With
+        ``check_deletions``, or by default once ``deletion_check_interval`` seconds
+        have passed since it was last done, the handles no longer in the repository's
+        (attribute-free) listing are removed too.
+        Returns a (changed, deleted) tuple with the number of records affected.
+        """
+        if not self.mirror.ready:
+            self.rebuild()
+            return len(self.mirror.handles()), 0
+        now = time.time()
+        if check_deletions is None:
+            checked = float(self.mirror.get_meta('deletions_checked', self.mirror.get_meta('built')))
+            check_deletions = now - checked >= self.deletion_check_interval
+        changed = [o for o in self.changed_since(self.mirror.watermark, MIRRORED_QUERY)
+                   if o.attributes.get('type') in MIRRORED_TYPES]
+        deleted = set()
+        if check_deletions:
+            deleted = self.mirror.handles() - set(self.all().object_handles)
+        self.mirror.apply(changed, deleted)
+        if check_deletions:
+            with self.mirror.connection:
+                self.mirror.set_meta('deletions_checked', str(now))
+        return len(changed), len(deleted)
+
+    def search(self, query=''):
+        if self.mirror.ready:
+            try:
+                records = self.mirror.search(query)
+            except UnsupportedQuery:
+                pass
+            else:
+                return DigitalObjectList(objects=[ObjectRecord(**r) for r in records], repository=self)
+        return super(MirroredRepository, self).search(query)
+
+    def object_changed(self, digital_object):
+        if digital_object.attributes.get('type') in MIRRORED_TYPES:
+            self.mirror.store(digital_object)
+
+    def object_deleted(self, digital_object):
+        self.mirror.remove(digital_object.handle)
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,178 @@
+"""
+Builds queries in the DO Repository's query language and plans how to run them.
+
+Queries are put together as trees of ('and', [...]), ('or', [...]), ('not', node)
+and ('term', field, value) tuples (the same shape ``mirror.QueryParser`` parses
+queries into), plus ('raw', query) for a query string given as it is. ``to_query``
+turns a tree into a query string, quoting values where needed, flattening nested
+groups and dropping repeated terms.
+
+A search for shapes in many categories (or with many handles) makes a long list of
+alternatives, and the repository only takes queries of limited length. ``plan``
+splits such a query into several whose results together are those of the original
+one; ``search`` runs them in parallel and merges their results.
+
+>>> node = all_of(term('objatt_type', 'shape'), raw('objatt_name:Circle'),
+...               any_of('objatt_category', ['1234/5', '1234/6', '1234/5']))
+>>> to_query(node)
+'objatt_type:shape AND (objatt_name:Circle) AND (objatt_category:1234/5 OR objatt_category:1234/6)'
+>>> to_query(any_of('objatt_name', ['Big circle', 'Square']))
+'objatt_name:"Big circle" OR objatt_name:Square'
+>>> for query in plan(all_of(term('objatt_type', 'shape'), any_of('id', ['1', '2', '3', '4', '5'])), max_terms=2):
+...     print query
+objatt_type:shape AND (id:1 OR id:2)
+objatt_type:shape AND (id:3 OR id:4)
+objatt_type:shape AND id:5
+"""
+import re
+
+from dorepository import DigitalObjectList, parallel_map
+import settings
+
+QUERY_MAX_TERMS = getattr(settings, 'QUERY_MAX_TERMS', 50)
+SEARCH_WORKERS = getattr(settings, 'SEARCH_WORKERS', 4)
+
+needs_quoting = re.compile(r'[\s()"\\]').search
+
+def term(field, value):
+    return ('term', field, str(value))
+
+def raw(query):
+    return ('raw', query)
+
+def all_of(*nodes):
+    return ('and', [node for node in nodes if node is not None])
+
+def any_of(field, values):
+    """
+    Matches objects whose ``field`` is any of ``values``.
+    """
+    return ('or', [term(field, value) for value in values])
+
+def either(*nodes):
+    return ('or', [node for node in nodes if node is not None])
+
+def negate(node):
+    return ('not', node)
+
+def normalize(node):
+    """
+    Flattens nested groups of the same kind, drops repeated and empty alternatives or
+    conditions and unwraps groups of one. Returns None for an empty group.
+    """
+    kind = node[0]
+    if kind == 'not':
+        inner = normalize(node[1])
+        return inner and ('not', inner)
+    if kind == 'raw':
+        return node if node[1] and node[1].strip() else None
+    if kind not in ('and', 'or'):
+        return node
+    children = []
+    for child in node[1]:
+        child = normalize(child)
+        if child is None:
+            continue
+        for grandchild in (child[1] if child[0] == kind else [child]):
+            if grandchild not in children:
+                children.append(grandchild)
+    if not children:
+        return None
+    if len(children) == 1:
+        return children[0]
+    return (kind, children)
+
+def quote(value):
+    r"""
+    ``value`` as a term of the query, in double quotes if it has spaces, parentheses,
+    quotes or backslashes; quotes and backslashes within are escaped.
+
+    >>> print quote('Circle'), quote('Big circle'), quote('The "red" one'), quote('a\\b')
+    Circle "Big circle" "The \"red\" one" "a\\b"
+    """
+    if needs_quoting(value) is None:
+        return value
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
+def _compile(node, top):
+    kind = node[0]
+    if kind == 'term':
+        return '%s:%s' % (node[1], quote(node[2]))
+    if kind == 'raw':
+        return '(%s)' % node[1]
+    if kind == 'not':
+        return 'NOT %s' % _compile(node[1], False)
+    query = (' %s ' % kind.upper()).join(_compile(child, False) for child in node[1])
+    return query if top else '(%s)' % query
+
+def to_query(node):
+    """
+    The query string for ``node``; an empty string if it has no conditions.
+    """
+    node = normalize(node)
+    if node is None:
+        return ''
+    return _compile(node, True)
+
+def _split(node, max_terms):
+    """
+    Yields nodes whose results together are those of ``node``, none with an
+    alternative (OR) of more than ``max_terms`` terms among its conditions.
+    """
+    if node[0] == 'or' and len(node[1]) > max_terms:
+        conditions, index = [node], 0
+    elif node[0] == 'and':
+        index = None
+        for i, child in enumerate(node[1]):
+            if child[0] == 'or' and len(child[1]) > max_terms and (index is None or len(child[1]) > len(node[1][index][1])):
+                index = i
+        conditions = node[1]
+    else:
+        index = None
+    if index is None:
+        yield node
+        return
+    alternatives = conditions[index][1]
+    for start in range(0, len(alternatives), max_terms):
+        chunk = ('or', alternatives[start:start + max_terms])
+        for part in _split(normalize(('and', conditions[:index] + [chunk] + conditions[index + 1:])), max_terms):
+            yield part
+
+def plan(node, max_terms=QUERY_MAX_TERMS):
+    """
+    Returns the list of query strings to run for ``node``: just one unless one of its
+    conditions is a choice between more than ``max_terms`` alternatives, in which case
+    those are split up between several queries. Only alternatives that are a condition
+    of the whole query (or the whole query) are split, so that the union of the results
+    is the result of the original query.
+    """
+    node = normalize(node)
+    if node is None:
+        return ['']
+    return [_compile(part, True) for part in _split(node, max_terms)]
+
+def search(repository, node, max_terms=QUERY_MAX_TERMS, max_workers=SEARCH_WORKERS):
+    """
+    Searches ``repository`` (a DigitalObjectRepository) for ``node`` and returns a
+    DigitalObjectList, oldest first whether or not the query is split up, as a sharded
+    repository and the mirror give their results. When it is, the queries are run in
+    parallel, ``max_workers`` at a time, and their results merged, each object once.
+    """
+    queries = plan(node, max_terms)
+    if len(queries) == 1:
+        results = [repository.search(queries[0])]
+    else:
+        results = parallel_map(repository.search, queries, max_workers)
+    objects = []
+    seen = set()
+    for result in results:
+        for record in result.object_handles:
+            if record.handle not in seen:
+                seen.add(record.handle)
+                objects.append(record)
+    objects.sort(key=lambda record: (record.created is None, record.created, record.handle))
+    return DigitalObjectList(objects=objects, repository=repository)
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,326 @@
+"""
+Renders shapes and categories as XML or JSON.
+
+Both formats are produced from the same intermediate structure: plain dicts and
+lists of strings built by the ``data`` methods of ``Shape``, ``ShapeList``,
+``Category`` and ``CategoryList``. Only building that structure touches the
+repository, so offering a second format costs no extra repository work.
+
+A shape looks like this (``file``, ``mask`` and ``categories`` are only there
+when details were asked for)::
+
+    {'id': ..., 'name': ..., 'created': ..., 'href': ...,
+     'file': {'href': ..., 'type': ..., 'name': ...}, 'mask': None,
+     'categories': [{'id': ..., 'name': ..., 'href': ...}]}
+
+and a category like this (``shapes`` only with details)::
+
+    {'id': ..., 'name': ..., 'href': ..., 'shapes': [...]}
+
+Every value is escaped on the way into the XML, so names containing ``&``, ``<``
+or quotes still give a well-formed document.
+
+>>> shape = {'id': '1234/5', 'name': 'Circle', 'created': '2012-01-01 00:00:00', 'href': 'http://example.com/shapes/1234%2F5/'}
+>>> shape_xml(shape, namespace=False)
+'<Shape name="Circle" created="2012-01-01 00:00:00" id="1234/5" xlink:href="http://example.com/shapes/1234%2F5/" />'
+>>> shape_xml(dict(shape, name='Fish & "Chips"'), namespace=False)
+'<Shape name="Fish &amp; &quot;Chips&quot;" created="2012-01-01 00:00:00" id="1234/5" xlink:href="http://example.com/shapes/1234%2F5/" />'
+>>> json_backend.loads(to_json([shape])) == [shape]
+True
+"""
+import re, base64, codecs
+from xml.sax.saxutils import escape as xml_escape
+
+try:
+    import ujson as json_backend
+except ImportError:
+    try:
+        import simplejson as json_backend
+    except ImportError:
+        import json as json_backend
+
+NAMESPACE = ' xmlns:xlink="http://www.w3.org/1999/xlink"'
+
+FORMATS = {
+    'xml': 'text/xml',
+    'json': 'application/json',
+}
+
+BUNDLE_FORMATS = {
+    'xml': 'multipart/mixed; boundary=%s',
+    'json': 'application/json',
+}
+
+# the media types an Accept header can ask for each format by
+ACCEPTED_TYPES = {
+    'xml': ('text/xml', 'application/xml'),
+    'json': ('application/json',),
+}
+
+def parse_accept(header):
+    """
+    Returns the media ranges of an Accept header as (range, quality) tuples.
+
+    >>> parse_accept('text/xml;q=0.1, Application/JSON, */*;q=bad')
+    [('text/xml', 0.1), ('application/json', 1.0), ('*/*', 0.0)]
+    """
+    ranges = []
+    for part in header.split(','):
+        params = part.split(';')
+        media_range = params[0].strip().lower()
+        if not media_range:
+            continue
+        quality = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        ranges.append((media_range, quality))
+    return ranges
+
+def media_quality(ranges, media_type):
+    """
+    The quality ``ranges`` give ``media_type``: that of the most specific range which
+    matches it, 0 if none does.
+    """
+    specificity, quality = -1, 0.0
+    for media_range, range_quality in ranges:
+        if media_range == media_type:
+            match = 2
+        elif media_range == media_type.split('/')[0] + '/*':
+            match = 1
+        elif media_range == '*/*':
+            match = 0
+        else:
+            continue
+        if match > specificity:
+            specificity, quality = match, range_quality
+    return quality
+
+def negotiate(accept):
+    """
+    The format (a key of FORMATS) an Accept header prefers: JSON if it gives JSON a
+    higher quality than XML, otherwise XML.
+
+    >>> negotiate('text/xml;q=0.1, application/json')
+    'json'
+    >>> negotiate('*/*;q=0.1, application/xhtml+xml')
+    'xml'
+    >>> negotiate('application/json;q=0.5, */*;q=0.5')
+    'xml'
+    >>> negotiate('application/json, text/*;q=0.9'), negotiate('')
+    ('json', 'xml')
+    """
+    ranges = parse_accept(accept)
+    def quality(format):
+        return max(media_quality(ranges, media_type) for media_type in ACCEPTED_TYPES[format])
+    if quality('json') > quality('xml'):
+        return 'json'
+    return 'xml'
+
+ATTRIBUTE_ENTITIES = {'"': '&quot;'}
+needs_escaping = re.compile(r'[&<>"]').search
+
+def utf8(value):
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+
+def to_json(data):
+    return json_backend.dumps(data)
+
+def escape(value):
+    """
+    Escapes ``value`` for use as text or as a double-quoted attribute value.
+    Values which are not strings are converted with ``str`` first and unicode is
+    encoded as UTF-8, so that a document never mixes unicode (names of uploaded files
+    are unicode) with non-ASCII byte strings (names given as form arguments are).
+
+    >>> escape(u'Caf\\xe9 & Co')
+    'Caf\\xc3\\xa9 &amp; Co'
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif not isinstance(value, basestring):
+        value = str(value)
+    if needs_escaping(value) is None:
+        return value
+    return xml_escape(value, ATTRIBUTE_ENTITIES)
+
+# Templates are formatted positionally; each slot takes an escaped value.
+FILE_TEMPLATE = '<%s xlink:href="%s" type="%s" name="%s" />'
+SHAPE_TEMPLATE = '<Shape name="%s" created="%s" id="%s"%s xlink:href="%s"'
+CATEGORY_TEMPLATE = '<Category id="%s" name="%s"%s xlink:href="%s"'
+RESULT_TEMPLATE = '<Result op="%s" id="%s" ok="%s"%s />'
+BYTERANGE_PART = '\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n'
+BUNDLE_PART = '--%s\r\nContent-Type: %s\r\nContent-Disposition: inline; name="%s"\r\n\r\n'
+
+def file_xml(tag, file_data):
+    return FILE_TEMPLATE % (tag, escape(file_data['href']), escape(file_data['type']), escape(file_data['name']))
+
+def _shape_xml(shape, namespace, append):
+    append(SHAPE_TEMPLATE % (escape(shape['name']), escape(shape['created']), escape(shape['id']), namespace, escape(shape['href'])))
+    if 'categories' in shape:
+        append('>')
+        if shape['file']:
+            append(file_xml('File', shape['file']))
+        if shape['mask']:
+            append(file_xml('Mask', shape['mask']))
+        if shape['categories']:
+            append('<Categories>')
+            for category in shape['categories']:
+                _category_xml(category, '', append)
+            append('</Categories>')
+        append('</Shape>')
+    else:
+        append(' />')
+
+def _category_xml(category, namespace, append):
+    append(CATEGORY_TEMPLATE % (escape(category['id']), escape(category['name']), namespace, escape(category['href'])))
+    if 'shapes' in category:
+        append('>')
+        if category['shapes']:
+            append('<Shapes>')
+            for shape in category['shapes']:
+                _shape_xml(shape, '', append)
+            append('</Shapes>')
+        append('</Category>')
+    else:
+        append(' />')
+
+def shape_xml(shape, namespace=True):
+    xml = []
+    _shape_xml(shape, NAMESPACE if namespace else '', xml.append)
+    return "".join(xml)
+
+def shapes_xml(shapes, namespace=True):
+    xml = ['<Shapes%s>' % (NAMESPACE if namespace else '')]
+    append = xml.append
+    for shape in shapes:
+        _shape_xml(shape, '', append)
+    append('</Shapes>')
+    return "".join(xml)
+
+def category_xml(category, namespace=True):
+    xml = []
+    _category_xml(category, NAMESPACE if namespace else '', xml.append)
+    return "".join(xml)
+
+def categories_xml(categories, namespace=True):
+    xml = ['<Categories%s>' % (NAMESPACE if namespace else '')]
+    append = xml.append
+    for category in categories:
+        _category_xml(category, '', append)
+    append('</Categories>')
+    return "".join(xml)
+
+def results_xml(results):
+    """
+    The results of a batch of operations (see ``ShapeRepository.batch``).
+    """
+    xml = ['<Results>']
+    for result in results:
+        error = ' error="%s"' % escape(result['error']) if 'error' in result else ''
+        xml.append(RESULT_TEMPLATE % (escape(result['op'] or ''), escape(result['id'] or ''), 'true' if result['ok'] else 'false', error))
+    xml.append('</Results>')
+    return "".join(xml)
+
+def body_chunks(body):
+    """
+    The pieces of an element body: a ``dorepository.MappedBody`` a chunk at a time, so
+    it is never copied into memory whole, anything else as it is.
+    """
+    return body.chunks() if hasattr(body, 'chunks') else [body]
+
+def element_json(body, mimetype):
+    """
+    A shape file or mask as JSON for a bundle, a piece at a time: SVG and other text is
+    embedded as it is, anything else (or text which isn't UTF-8) as base64.
+
+    >>> import json
+    >>> svg = json.loads("".join(element_json('<svg>\\xc3\\xa9</svg>', 'image/svg+xml')))
+    >>> svg['encoding'], svg['body']
+    (u'utf-8', u'<svg>\\xe9</svg>')
+    >>> png = json.loads("".join(element_json('\\x89PNG\\xff' * 30000, 'image/png')))
+    >>> base64.b64decode(png['body']) == '\\x89PNG\\xff' * 30000
+    True
+    """
+    text = mimetype and (mimetype.startswith('text/') or mimetype.endswith('xml'))
+    if text:
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        try:
+            for chunk in body_chunks(body):
+                decoder.decode(chunk)
+            decoder.decode('', True)
+        except UnicodeDecodeError:
+            text = False
+    yield '{"type": %s, "encoding": "%s", "body": "' % (to_json(mimetype), 'utf-8' if text else 'base64')
+    if text:
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        for chunk in body_chunks(body):
+            yield to_json(decoder.decode(chunk))[1:-1]
+    else:
+        # encoded three bytes at a time, so the pieces join up into one base64 string
+        rest = ''
+        for chunk in body_chunks(body):
+            chunk = rest + chunk
+            cut = len(chunk) - len(chunk) % 3
+            yield base64.b64encode(chunk[:cut])
+            rest = chunk[cut:]
+        yield base64.b64encode(rest)
+    yield '"}'
+
+def bundle_json(shape_json, elements):
+    """
+    A shape (already rendered as JSON) together with its file and mask, given in
+    ``elements`` as (body, mimetype) tuples keyed by 'file' and 'mask', as the pieces
+    of a JSON document.
+    """
+    yield '{"shape": '
+    yield shape_json
+    for name in ('file', 'mask'):
+        element = elements.get(name)
+        yield ', "%s": ' % name
+        if element:
+            for piece in element_json(*element):
+                yield piece
+        else:
+            yield 'null'
+    yield '}'
+
+def bundle_multipart(shape_xml, elements, boundary):
+    """
+    A shape (already rendered as XML) together with its file and mask as the pieces of
+    a multipart/mixed body; each part is named by its Content-Disposition. The XML
+    (which is unicode when a name isn't ASCII) is sent as UTF-8, next to the bodies
+    as they are.
+
+    >>> body = "".join(bundle_multipart(u'<Shape name="Caf\\xe9" />', {'file': ('\\x89PNG\\xff', 'image/png')}, 'b'))
+    >>> isinstance(body, str), 'Caf\\xc3\\xa9' in body, '\\x89PNG\\xff' in body
+    (True, True, True)
+    """
+    yield utf8(BUNDLE_PART % (boundary, 'text/xml', 'shape')) + utf8(shape_xml)
+    for name in ('file', 'mask'):
+        if elements.get(name):
+            body, mimetype = elements[name]
+            yield "\r\n" + utf8(BUNDLE_PART % (boundary, mimetype, name))
+            for chunk in body_chunks(body):
+                yield chunk
+    yield '\r\n--%s--\r\n' % boundary
+
+def byteranges_multipart(parts, mimetype, size, boundary):
+    """
+    A multipart/byteranges body for ``parts``, a list of (start, end, body) tuples of a
+    ``size`` bytes long element.
+    """
+    xml = []
+    for start, end, body in parts:
+        xml.append(BYTERANGE_PART % (boundary, mimetype, start, end, size))
+        xml.append(body)
+    xml.append('\r\n--%s--\r\n' % boundary)
+    return "".join(xml)
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -1,23 +1,714 @@
 import tornado.ioloop
 import tornado.web
-import os
+import tornado.httpserver
+import tornado.netutil
+import tornado.process
+import tornado.gen
+import tornado.concurrent
+import os, time, math, random, logging, cProfile, urlparse, urllib, signal, errno, uuid
+import re, sys, threading, urllib2
+from StringIO import StringIO
 
-import settings, shapes
+import settings, shapes, dorepository, cache, mirror, render, export, admission
+
+PROFILE_HEADERS = getattr(settings, 'PROFILE_HEADERS', False)
+SLOW_REQUEST_THRESHOLD = getattr(settings, 'SLOW_REQUEST_THRESHOLD', 1.0)
+PROFILE_SAMPLE_RATE = getattr(settings, 'PROFILE_SAMPLE_RATE', 0.0)
+PROFILE_DIR = getattr(settings, 'PROFILE_DIR', None)
+PROCESSES = getattr(settings, 'PROCESSES', 1)
+SHUTDOWN_GRACE = getattr(settings, 'SHUTDOWN_GRACE', 10.0)
+CACHE_TIMEOUT = getattr(settings, 'CACHE_TIMEOUT', 300)
+CACHE_STALE_TIMEOUT = getattr(settings, 'CACHE_STALE_TIMEOUT', 3600)
+MIRROR_PATH = getattr(settings, 'MIRROR_PATH', None)
+SYNC_INTERVAL = getattr(settings, 'SYNC_INTERVAL', 60)
+HEALTH_CHECK_INTERVAL = getattr(settings, 'DO_HEALTH_CHECK_INTERVAL', 30)
+REQUEST_DEADLINE = getattr(settings, 'REQUEST_DEADLINE', 30.0)
+EXPORT_DEADLINE = getattr(settings, 'EXPORT_DEADLINE', 3600.0)
+EXPORT_CHUNK_SIZE = getattr(settings, 'EXPORT_CHUNK_SIZE', 64 * 1024)
+BATCH_DEADLINE = getattr(settings, 'BATCH_DEADLINE', 600.0)
+BATCH_MAX_OPERATIONS = getattr(settings, 'BATCH_MAX_OPERATIONS', 10000)
+ADMISSION_CONTROL = getattr(settings, 'ADMISSION_CONTROL', True)
+ADMISSION_LIMITS = getattr(settings, 'ADMISSION_LIMITS', {})
+MAX_CONCURRENT_REQUESTS = getattr(settings, 'MAX_CONCURRENT_REQUESTS', 100)
+MAX_QUEUED_REQUESTS = getattr(settings, 'MAX_QUEUED_REQUESTS', 200)
+WARM_UP = getattr(settings, 'WARM_UP', True)
+WARM_UP_SHAPES = getattr(settings, 'WARM_UP_SHAPES', 100)
+WARM_UP_DEADLINE = getattr(settings, 'WARM_UP_DEADLINE', 300.0)
+WARM_UP_WORKERS = getattr(settings, 'WARM_UP_WORKERS', 4)
+
+log = logging.getLogger('shapesapi.server')
+
+NOT_FOUND_ERRORS = (dorepository.DigitalObjectNotFound, shapes.ShapeInvalidRecord, shapes.CategoryNotFound)
+
+def route_classes():
+    """
+    The request classes of ``admission.ROUTE_CLASSES``, with the (concurrency, longest
+    wait) pairs of ``settings.ADMISSION_LIMITS`` applied.
+    """
+    classes = dict(admission.ROUTE_CLASSES)
+    for name, (concurrency, max_wait) in ADMISSION_LIMITS.items():
+        classes[name] = classes[name]._replace(concurrency=concurrency, max_wait=max_wait)
+    return classes
+
+admission_controller = admission.AdmissionController(route_classes(), MAX_CONCURRENT_REQUESTS, MAX_QUEUED_REQUESTS)
 
 class MethodNotAllowed(tornado.web.HTTPError):
     def __init__(self, method=None, *args, **kwargs):
         super(MethodNotAllowed,self).__init__(405, "Method %s not allowed", [method], *args, **kwargs)
 
-class ShapeHandler(tornado.web.RequestHandler):
+def call_kind(method, url):
+    """
+    Classify a DO repository call so that the time spent on it can be broken down
+    by what it was for (shape searches, category lookups, element downloads...)
+    """
+    if method in ('PUT', 'POST', 'DELETE'):
+        return method.lower()
+    parsed = urlparse.urlparse(url)
+    if parsed.query:
+        query = urlparse.parse_qs(parsed.query).get('query', [''])[0]
+        for object_type in ('shape', 'category'):
+            if 'objatt_type:%s' % object_type in query:
+                return 'search(%s)' % object_type
+        return 'search'
+    if '/el/' in parsed.path:
+        return 'element'
+    return 'object'
+
+class RequestProfile(object):
+    """
+    Accounts for the DO repository round trips made while handling a single request.
+
+    Use it as a context manager; while it is active every call made under the
+    request's ``deadline`` (in whichever thread) is counted and timed, grouped by the
+    kind of call. Calls made for other requests, which run under their own deadlines,
+    are not.
+    """
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.requests = 0
+        self.do_time = 0.0
+        self.calls = {}
+        self.start = None
+        self.elapsed = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def __call__(self, method, url, elapsed):
+        with self.lock:
+            if method is None:
+                kind = getattr(self.local, 'last_kind', None) or call_kind('GET', url)
+            else:
+                kind = self.local.last_kind = call_kind(method, url)
+                self.requests += 1
+            self.do_time += elapsed
+            count, total = self.calls.get(kind, (0, 0.0))
+            self.calls[kind] = (count + (method is not None), total + elapsed)
+
+    def __enter__(self):
+        self.start = time.time()
+        self.deadline.listeners.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self in self.deadline.listeners:
+            self.deadline.listeners.remove(self)
+        self.elapsed = time.time() - self.start
+
+    @property
+    def other_time(self):
+        """Time not spent waiting on the repository (rendering, XML building...)"""
+        return max((self.elapsed or 0.0) - self.do_time, 0.0)
+
+    def breakdown(self):
+        calls = ["%s: %dx %.1fms" % (kind, count, total * 1000) for kind, (count, total) in sorted(self.calls.items())]
+        calls.append("other: %.1fms" % (self.other_time * 1000))
+        return "; ".join(calls)
+
+class BaseHandler(tornado.web.RequestHandler):
+    """
+    Base class for all handlers. Every request is wrapped in a ``RequestProfile``;
+    requests slower than ``settings.SLOW_REQUEST_THRESHOLD`` seconds are logged with their
+    call breakdown and a sample of them (``settings.PROFILE_SAMPLE_RATE``) gets a cProfile
+    dump written to ``settings.PROFILE_DIR``.
+
+    Each request also gets a deadline (``deadline_seconds``, ``settings.REQUEST_DEADLINE``
+    by default) that bounds the time spent on calls to the DO repository.
+
+    Before it is handled, a request has to be let in by the admission controller (see
+    ``admission.py``) as a request of class ``admission`` (``write_admission`` for
+    POST, PUT and DELETE); if it is turned away the client gets a 503 at once.
+    Subclasses which override ``prepare`` return the result of this one.
+    """
+    active_requests = 0
+    deadline_seconds = REQUEST_DEADLINE
+    admission = 'shape'
+    write_admission = 'write'
+    admitted = None
+    streaming = False
+
+    def initialize(self):
+        # handlers are created once the whole body has been received
+        self.received = time.time()
+        BaseHandler.active_requests += 1
+        self.deadline = dorepository.Deadline(self.deadline_seconds).__enter__()
+        self.profile = RequestProfile(self.deadline).__enter__()
+        self.profiler = None
+        if PROFILE_DIR and PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def admission_class(self):
+        if self.request.method in ('POST', 'PUT', 'DELETE'):
+            return self.write_admission
+        return self.admission
+
+    @tornado.gen.coroutine
     def prepare(self, *args, **kwargs):
-        self.repository = shapes.ShapeRepository(url=settings.DO_URL)
+        if not ADMISSION_CONTROL:
+            return
+        name = self.admission_class()
+        # waiting starts when the request came in, or, for one with a body, once the
+        # body has been received: a slow upload isn't kept waiting by the server
+        arrived = self.received if self.request.body else self.request._start_time
+        admitted = admission_controller.admit(name, time.time() - arrived)
+        if not admitted.done():
+            # other requests run on the IOLoop while this one waits its turn
+            self.deadline.__exit__()
+            try:
+                yield admitted
+            except admission.Shed:
+                pass
+            self.deadline.__enter__()
+        if admitted.exception():
+            self.service_unavailable(admitted.exception().retry_after, "The server is too busy to answer right now.")
+            return
+        self.admitted = name
 
-    def get(self, handle=None, *args):
-        if handle:
-            self.write(self.repository.get(handle).xml(True))
+    def service_unavailable(self, retry_after, message):
+        self.set_status(503)
+        self.set_header('Retry-After', str(int(math.ceil(retry_after or 1))))
+        self.finish("<html><title>503: Service Unavailable</title><body>%s</body></html>" % message)
+
+    def negotiate_format(self):
+        """
+        The representation the client asked for: the ``format`` argument if it is given,
+        otherwise the one the Accept header prefers (see ``render.negotiate``). Every
+        response that negotiates varies by Accept, since caches key it on the URL alone.
+        """
+        self.set_header('Vary', 'Accept')
+        format = self.get_argument('format', None)
+        if format in render.FORMATS:
+            return format
+        return render.negotiate(self.request.headers.get('Accept', ''))
+
+    def serialize(self, obj, format, details=True):
+        return serialize(obj, format, details)
+
+    @tornado.gen.coroutine
+    def rendering(self, kind, handle, format):
+        """
+        A Future for the rendering of a shape or category (or of the list of all of
+        them, without a ``handle``) in ``format``, from the shared cache if it is there.
+        A rendering which is out of date, but by less than ``settings.CACHE_STALE_TIMEOUT``
+        seconds, is still used while it is rendered again in the background. Otherwise
+        it is rendered in a thread, so the IOLoop goes on taking (or turning away)
+        other requests meanwhile.
+        """
+        rendered = cache.get_cache('rendered')
+        key = rendering_key(kind, handle, format)
+        body, fresh = rendered.get_stale(key, CACHE_STALE_TIMEOUT)
+        if body is None:
+            generation = rendering_generation()
+            body = yield self.in_thread(render_resource, kind, handle, format)
+            self.cache_result(rendered, key, body, generation)
+        elif not fresh:
+            refresh_rendering(kind, handle, format)
+        raise tornado.gen.Return(body)
+
+    def in_thread(self, function, *args):
+        """
+        Runs ``function`` in a thread of its own, so a long job doesn't hold up the IOLoop,
+        and returns a Future for its result. The request deadline moves to that thread.
+        """
+        io_loop = tornado.ioloop.IOLoop.current()
+        future = tornado.concurrent.Future()
+        deadline = self.deadline
+        def run():
+            try:
+                with deadline:
+                    result = function(*args)
+            except Exception:
+                io_loop.add_callback(future.set_exc_info, sys.exc_info())
+            else:
+                io_loop.add_callback(future.set_result, result)
+        deadline.__exit__()
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return future
+
+    @tornado.gen.coroutine
+    def stream(self, pieces):
+        """
+        Sends the body as ``pieces``, flushing about a chunk (``dorepository.SPOOL_CHUNK_SIZE``)
+        at a time before the next piece is read, so a ``dorepository.MappedBody`` is never
+        copied into memory whole. Other requests run on the IOLoop meanwhile, so the
+        deadline is put aside first.
+        """
+        self.streaming = True
+        self.deadline.__exit__()
+        pending = 0
+        for piece in pieces:
+            self.write(piece)
+            pending += len(piece)
+            if pending >= dorepository.SPOOL_CHUNK_SIZE:
+                yield self.flush()
+                pending = 0
+
+    def compute_etag(self):
+        # a streamed body has left the write buffer before the ETag would be computed
+        if self.streaming:
+            return None
+        return super(BaseHandler, self).compute_etag()
+
+    def cache_result(self, rendered, key, body, generation):
+        """
+        Store a rendering in the shared cache unless it had to leave something out or
+        the cache was invalidated since ``generation`` was read (see ``store_rendering``).
+        """
+        if not self.deadline.degraded:
+            store_rendering(rendered, key, body, generation)
+
+    def finish(self, *args, **kwargs):
+        if self.profile.elapsed is None:
+            self.deadline.__exit__()
+            self.profile.__exit__()
+            if self.profiler:
+                self.profiler.disable()
+        if self.deadline.degraded:
+            self.set_header('X-Degraded', ", ".join(self.deadline.degraded))
+        if PROFILE_HEADERS:
+            self.set_header('X-DO-Requests', str(self.profile.requests))
+            self.set_header('X-DO-Time', '%.1fms' % (self.profile.do_time * 1000))
+        return super(BaseHandler, self).finish(*args, **kwargs)
+
+    def log_exception(self, typ, value, tb):
+        # a shape or category that isn't there is the client's mistake, as with a 404
+        # HTTPError: a warning without the traceback
+        if isinstance(value, NOT_FOUND_ERRORS):
+            log.warning("%d %s: %s", 404, self._request_summary(), value)
+            return
+        super(BaseHandler, self).log_exception(typ, value, tb)
+
+    def write_error(self, status_code, **kwargs):
+        exc_info = kwargs.get('exc_info')
+        if exc_info and isinstance(exc_info[1], dorepository.DORepositoryUnavailable):
+            self.service_unavailable(exc_info[1].retry_after, "The shape repository is temporarily unavailable.")
+            return
+        if exc_info and isinstance(exc_info[1], NOT_FOUND_ERRORS):
+            self.set_status(404)
+            self.finish("<html><title>404: Not Found</title><body>%s</body></html>" % render.escape(exc_info[1]))
+            return
+        if exc_info and isinstance(exc_info[1], dorepository.DeadlineExceeded):
+            self.set_status(504)
+            self.finish("<html><title>504: Gateway Timeout</title><body>The shape repository took too long to answer.</body></html>")
+            return
+        return super(BaseHandler, self).write_error(status_code, **kwargs)
+
+    def on_finish(self):
+        BaseHandler.active_requests -= 1
+        if self.admitted:
+            admission_controller.release(self.admitted)
+            self.admitted = None
+        profile = self.profile
+        if profile.elapsed < SLOW_REQUEST_THRESHOLD:
+            return
+        log.warning("Slow request %s %s %.1fms (%d DO requests, %.1fms) %s",
+                    self.request.method, self.request.uri, profile.elapsed * 1000,
+                    profile.requests, profile.do_time * 1000, profile.breakdown())
+        if self.profiler:
+            filename = os.path.join(PROFILE_DIR, "%s-%s-%d.prof" % (
+                                    self.request.method, urllib.quote_plus(self.request.path), time.time() * 1000))
+            self.profiler.dump_stats(filename)
+
+def serialize(obj, format, details=True):
+    """
+    Render a shape, category or list of either in ``format`` ('xml' or 'json').
+    """
+    if format == 'json':
+        return obj.json(details)
+    return obj.xml(True, details)
+
+_repository = None
+def get_repository():
+    """
+    Returns the DO repository shared by all handlers. If ``settings.MIRROR_PATH`` is set,
+    searches are answered from a local mirror of the shape and category records.
+    """
+    global _repository
+    if _repository is None:
+        if MIRROR_PATH:
+            _repository = mirror.MirroredRepository(settings.DO_URL, MIRROR_PATH)
         else:
-            self.write(self.repository.all().xml(True))
-        self.set_header('Content-Type', "text/xml")
+            _repository = dorepository.DigitalObjectRepository(settings.DO_URL)
+    return _repository
+
+ELEMENT_LABELS = ('content', 'mask')
+
+def shape_element(shape, label):
+    """
+    The DigitalObjectFile holding the file or mask of ``shape``, or None.
+    """
+    shape_file = shape.mask if label == 'mask' else shape.file
+    return shape_file and shape_file.do_file
+
+def remember_locations(shape):
+    """
+    Record where the file and mask of ``shape`` are (element URL, mimetype and size) in
+    the shared 'locations' cache, so later downloads can skip looking the shape up.
+    That a shape has no mask is only remembered for ``settings.CACHE_TIMEOUT`` seconds.
+    """
+    locations = cache.get_cache('locations')
+    for label in ELEMENT_LABELS:
+        do_file = shape_element(shape, label)
+        key = '%s:%s' % (label, shape.handle)
+        if do_file:
+            locations.set(key, render.to_json([do_file.url, do_file.mimetype, getattr(do_file, 'size', None)]))
+        else:
+            locations.set(key, render.to_json(None), CACHE_TIMEOUT)
+
+def located_elements(handle, labels):
+    """
+    Returns a dict of DigitalObjectFile objects (None for elements the shape doesn't
+    have) built from the 'locations' cache for the files of a shape, or None unless
+    the location of every one of ``labels`` is known.
+    """
+    locations = cache.get_cache('locations')
+    do_files = {}
+    for label in labels:
+        location = locations.get('%s:%s' % (label, handle))
+        if location is None:
+            return None
+        location = render.json_backend.loads(location)
+        if location:
+            url, mimetype, size = location
+            do_files[label] = dorepository.DigitalObjectFile(url=str(url), mimetype=str(mimetype), size=size)
+        else:
+            do_files[label] = None
+    return do_files
+
+def get_elements(repository, handle, labels=ELEMENT_LABELS, shape=None):
+    """
+    Returns a dict of (body, mimetype) tuples for the files of a shape (its 'content'
+    and 'mask'), going through the cache shared by all worker processes. Bodies larger
+    than ``settings.SPOOL_THRESHOLD`` are given as a ``dorepository.MappedBody`` rather
+    than a string. Elements the shape doesn't have are left out. Whatever is missing from the cache is downloaded in
+    parallel, straight from the element URLs if their locations are known; otherwise
+    the shape is looked up first (unless ``shape`` is given).
+    """
+    files = cache.get_cache('files')
+    elements = {}
+    missing = []
+    for label in labels:
+        key = '%s:%s' % (label, handle)
+        mimetype = files.get(key + ':mimetype')
+        body_file = files.open(key) if mimetype is not None else None
+        if body_file is None:
+            missing.append(label)
+        else:
+            elements[label] = (dorepository.file_body(body_file), mimetype)
+    if not missing:
+        return elements
+
+    def download(do_files):
+        do_files = [(label, do_file) for label, do_file in do_files.items() if do_file]
+        bodies = dorepository.parallel_map(lambda (label, do_file): do_file.download(), do_files)
+        for (label, do_file), body in zip(do_files, bodies):
+            key = '%s:%s' % (label, handle)
+            files.set(key, body)
+            files.set(key + ':mimetype', do_file.mimetype)
+            elements[label] = (body, do_file.mimetype)
+
+    do_files = located_elements(handle, missing) if shape is None else None
+    if do_files is not None:
+        try:
+            download(do_files)
+            return elements
+        except urllib2.HTTPError, inst:
+            if inst.code != 404:
+                raise
+            # the shape changed or went away: forget where its files were and look it up
+            forget_locations(handle)
+    if shape is None:
+        shape = repository.get(handle)
+    remember_locations(shape)
+    download(dict((label, shape_element(shape, label)) for label in missing))
+    return elements
+
+def forget_locations(handle):
+    locations = cache.get_cache('locations')
+    for label in ELEMENT_LABELS:
+        locations.delete('%s:%s' % (label, handle))
+
+def get_element(repository, handle, label='content'):
+    """
+    Returns a (body, mimetype) tuple for the file or mask of a shape, or None if the
+    shape has no such element.
+    """
+    return get_elements(repository, handle, (label,)).get(label)
+
+MAX_RANGES = 16
+
+def parse_ranges(header, size):
+    """
+    Parses a Range header for an element of ``size`` bytes into a sorted list of
+    (start, end) byte positions, both included, merging ranges which overlap or touch.
+    Returns None if the header should be ignored (it isn't a valid bytes range or asks
+    for more than MAX_RANGES ranges) and an empty list if no range can be satisfied.
+    """
+    unit, _, specs = header.partition('=')
+    if unit.strip() != 'bytes' or not specs.strip():
+        return None
+    specs = specs.split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+    ranges = []
+    for spec in specs:
+        first, dash, last = spec.strip().partition('-')
+        if not dash or not (first.isdigit() or (not first and last.isdigit())) or (last and not last.isdigit()):
+            return None
+        if not first:
+            start, end = max(size - int(last), 0), size - 1 # the last bytes
+        else:
+            start, end = int(first), min(int(last), size - 1) if last else size - 1
+        if last and first and int(last) < start:
+            return None
+        if start <= end:
+            ranges.append((start, end))
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+class FileElement(object):
+    """
+    A shape file or mask read from a local file (an entry of the shared cache).
+    """
+    def __init__(self, body_file, size, mimetype):
+        self.body_file = body_file
+        self.size = size
+        self.mimetype = mimetype
+
+    def read_ranges(self, ranges):
+        if isinstance(self.body_file, dorepository.MappedBody):
+            return [self.body_file[start:end + 1] for start, end in ranges]
+        bodies = []
+        for start, end in ranges:
+            self.body_file.seek(start)
+            bodies.append(self.body_file.read(end - start + 1))
+        return bodies
+
+    def close(self):
+        # a MappedBody may still be kept by its DigitalObjectFile; it goes with its last reference
+        if not isinstance(self.body_file, dorepository.MappedBody):
+            self.body_file.close()
+
+class RemoteElement(object):
+    """
+    A shape file or mask read from the repository, a range at a time.
+    """
+    def __init__(self, do_file, size, mimetype):
+        self.do_file = do_file
+        self.size = size
+        self.mimetype = mimetype
+
+    def read_ranges(self, ranges):
+        return dorepository.parallel_map(lambda (start, end): self.do_file.fetch_range(start, end), ranges)
+
+    def close(self):
+        pass
+
+def get_element_source(repository, handle, label='content'):
+    """
+    Returns a FileElement or RemoteElement for reading parts of the file or mask of a
+    shape, or None if the shape has no such element. Cached elements are read from the
+    cache; otherwise, if the repository tells the size of the element, only the ranges
+    read are downloaded. If it doesn't, the whole element is fetched (and cached).
+    """
+    files = cache.get_cache('files')
+    key = '%s:%s' % (label, handle)
+    mimetype = files.get(key + ':mimetype')
+    body_file = files.open(key) if mimetype is not None else None
+    if body_file:
+        return FileElement(body_file, os.fstat(body_file.fileno()).st_size, mimetype)
+    do_files = located_elements(handle, (label,))
+    if do_files is not None:
+        do_file = do_files[label]
+    else:
+        shape = repository.get(handle)
+        remember_locations(shape)
+        do_file = shape_element(shape, label)
+    if not do_file:
+        return None
+    size = getattr(do_file, 'size', None)
+    if size is not None:
+        return RemoteElement(do_file, int(size), do_file.mimetype)
+    element = get_element(repository, handle, label)
+    if not element:
+        return None
+    body, mimetype = element
+    if isinstance(body, dorepository.MappedBody):
+        return FileElement(body, len(body), mimetype)
+    return FileElement(StringIO(body), len(body), mimetype)
+
+LISTINGS = {'shape': 'shapes', 'category': 'categories'}
+
+def rendering_key(kind, handle, format):
+    """
+    The key in the 'rendered' cache of a shape or category (``kind``) or, without a
+    ``handle``, of the list of all of them.
+    """
+    if handle:
+        return '%s:%s.%s' % (kind, handle, format)
+    return '%s.%s' % (LISTINGS[kind], format)
+
+def render_resource(kind, handle, format):
+    """
+    Renders a shape or category, or the list of all of them, as the handlers serve it.
+    """
+    if kind == 'shape':
+        shape_repository = shapes.ShapeRepository(repository=get_repository())
+        if handle:
+            shape = shape_repository.get(handle)
+            remember_locations(shape)
+            return serialize(shape, format)
+        return serialize(shape_repository.all(), format)
+    category_repository = shapes.CategoryRepository(repository=get_repository())
+    if handle:
+        return serialize(category_repository.get(handle), format, details=True)
+    return serialize(category_repository.all(), format, details=False)
+
+def rendering_generation():
+    """
+    The generation of the 'rendered' cache, which every ``invalidate`` changes. It is
+    kept in a cache of its own so that clearing the renderings doesn't reset it.
+    """
+    return cache.get_cache('generations').get('rendered')
+
+def store_rendering(rendered, key, body, generation):
+    """
+    Store a rendering made from what the repository held at ``generation`` (read
+    before rendering started), unless the cache has been invalidated since.
+    """
+    if rendering_generation() != generation:
+        return
+    rendered.set(key, body, CACHE_TIMEOUT)
+    if rendering_generation() != generation: # invalidated while it was being stored
+        rendered.delete(key)
+
+_refreshing = set()
+def refresh_rendering(kind, handle, format):
+    """
+    Render a stale entry of the 'rendered' cache again in a background thread. Meanwhile
+    the entry counts as fresh for ``settings.REQUEST_DEADLINE`` seconds, so that neither
+    this process nor the others start refreshing it too. The new rendering is only
+    stored if nothing was left out of it and the cache wasn't invalidated meanwhile,
+    so it can't replace a rendering made after a change it doesn't show.
+    """
+    key = rendering_key(kind, handle, format)
+    if key in _refreshing:
+        return
+    _refreshing.add(key)
+    rendered = cache.get_cache('rendered')
+    rendered.touch(key, REQUEST_DEADLINE)
+    io_loop = tornado.ioloop.IOLoop.current()
+    def run():
+        try:
+            generation = rendering_generation()
+            with dorepository.Deadline(REQUEST_DEADLINE) as deadline:
+                body = render_resource(kind, handle, format)
+            if not deadline.degraded:
+                store_rendering(rendered, key, body, generation)
+        except Exception:
+            log.exception("Refreshing %s failed", key)
+        finally:
+            io_loop.add_callback(_refreshing.discard, key)
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+
+def warm_up():
+    """
+    Fill the shared caches before any request is served: the lists of shapes and of
+    categories and every category in each format, and the newest
+    ``settings.WARM_UP_SHAPES`` shapes along with where their files are. Renderings
+    are only stored if nothing had to be left out of them; whatever isn't done within
+    ``settings.WARM_UP_DEADLINE`` seconds is left to the first requests.
+    """
+    rendered = cache.get_cache('rendered')
+    if isinstance(rendered, cache.NullCache):
+        return
+    start = time.time()
+    repository = get_repository()
+    with dorepository.Deadline(WARM_UP_DEADLINE) as deadline:
+        def store(kind, handle, obj, details=True):
+            for format in render.FORMATS:
+                body = serialize(obj, format, details)
+                if not deadline.degraded:
+                    rendered.set(rendering_key(kind, handle, format), body, CACHE_TIMEOUT)
+
+        def warm_category(category):
+            store('category', category.handle, category)
+
+        try:
+            shape_list = shapes.ShapeRepository(repository=repository).all()
+            store('shape', None, shape_list)
+            categories = shapes.CategoryRepository(repository=repository).all()
+            store('category', None, categories, details=False)
+            dorepository.parallel_map(warm_category, list(categories), WARM_UP_WORKERS)
+            for shape in (shape_list[-WARM_UP_SHAPES:] if WARM_UP_SHAPES else []):
+                remember_locations(shape)
+                store('shape', shape.handle, shape)
+        except Exception:
+            log.exception("Warm-up stopped after %.1fs", time.time() - start)
+            return
+    log.info("Warm-up done in %.1fs", time.time() - start)
+
+def invalidate(*handles):
+    """
+    Drop cached renderings after a change to the repository, along with the cached
+    files and masks of ``handles`` (and where they were) if shapes were deleted.
+    Renderings started before are no longer stored (see ``store_rendering``).
+    """
+    cache.get_cache('generations').set('rendered', uuid.uuid4().hex)
+    cache.get_cache('rendered').clear()
+    files = cache.get_cache('files')
+    for handle in handles:
+        forget_locations(handle)
+        for label in ('content', 'mask'):
+            files.delete('%s:%s' % (label, handle))
+            files.delete('%s:%s:mimetype' % (label, handle))
+
+class ShapeHandler(BaseHandler):
+    def prepare(self, *args, **kwargs):
+        self.repository = shapes.ShapeRepository(repository=get_repository())
+        return super(ShapeHandler, self).prepare()
+
+    def admission_class(self):
+        if self.request.method == 'GET' and not (self.path_args and self.path_args[0]):
+            return 'listing'
+        return super(ShapeHandler, self).admission_class()
+
+    @tornado.gen.coroutine
+    def get(self, handle=None, *args):
+        format = self.negotiate_format()
+        body = yield self.rendering('shape', handle, format)
+        self.write(body)
+        self.set_header('Content-Type', render.FORMATS[format])
             
 
     def put(self, *args):
@@ -36,9 +727,12 @@ class ShapeHandler(tornado.web.RequestHandler):
         if self.request.files.has_key('mask'):
             mask =  self.request.files['mask'][0]
         shape = self.repository.create(name=name, file=file, mask=mask, categories=categories, creator=creator, school=school)
-        resp = shape.xml(True)
+        invalidate()
+        remember_locations(shape)
+        format = self.negotiate_format()
+        resp = self.serialize(shape, format)
         self.set_status(201)
-        self.set_header('Content-Type', 'text/xml')
+        self.set_header('Content-Type', render.FORMATS[format])
         self.set_header('Location', shape.url)
         self.write(resp)
 
@@ -47,10 +741,12 @@ class ShapeHandler(tornado.web.RequestHandler):
             raise tornado.web.HTTPError(405, "Method %s not allowed", ("DELETE",))
         shape = self.repository.get(handle)
         shape.delete()
+        invalidate(handle)
 
-class ShapeFormHandler(tornado.web.RequestHandler):
+class ShapeFormHandler(BaseHandler):
     def prepare(self, *args, **kwargs):
-        self.cat_repository = shapes.CategoryRepository(url=settings.DO_URL)
+        self.cat_repository = shapes.CategoryRepository(repository=get_repository())
+        return super(ShapeFormHandler, self).prepare()
     
     def get(self):
         categories = self.cat_repository.all()
@@ -69,14 +765,86 @@ class ShapeFormHandler(tornado.web.RequestHandler):
         shape.delete()
             
 
-class ShapeFileHandler(tornado.web.RequestHandler):
+class ElementHandler(BaseHandler):
+    """
+    Sends the file or mask (``label``) of a shape. A Range header gets the bytes asked
+    for (as multipart/byteranges if there are several ranges), read from the shared
+    cache if the element is there and otherwise fetched with ranged GETs from the
+    repository, so a partial read never downloads the whole element.
+    """
+    label = 'content'
+    admission = 'element'
+
     def prepare(self, *args, **kwargs):
-        self.repository = shapes.ShapeRepository(url=settings.DO_URL)
-        
+        self.repository = shapes.ShapeRepository(repository=get_repository())
+        return super(ElementHandler, self).prepare()
+
+    def not_found(self, handle):
+        raise tornado.web.HTTPError(404, '%s not found for shape %s' % ('Mask' if self.label == 'mask' else 'File', handle))
+
+    @tornado.gen.coroutine
     def get(self, handle):
-        shape = self.repository.get(handle)
-        self.write(shape.file.body)
-        self.set_header('Content-Type', shape.file.mimetype)
+        self.set_header('Accept-Ranges', 'bytes')
+        range_header = self.request.headers.get('Range')
+        # without a validator to check If-Range against, the whole element is sent
+        if range_header and not self.request.headers.get('If-Range'):
+            try:
+                sent = self.send_ranges(handle, range_header)
+            except urllib2.HTTPError, inst:
+                if inst.code != 404:
+                    raise
+                # the shape changed or went away: forget where its files were and look it up
+                forget_locations(handle)
+                sent = self.send_ranges(handle, range_header)
+            if sent:
+                return
+        element = get_element(self.repository, handle, self.label)
+        if not element:
+            self.not_found(handle)
+        body, mimetype = element
+        self.set_header('Content-Type', mimetype)
+        self.set_header('Content-Length', str(len(body)))
+        if isinstance(body, dorepository.MappedBody):
+            yield self.stream(body.chunks())
+        else:
+            self.write(body)
+
+    def send_ranges(self, handle, range_header):
+        """
+        Sends the ranges of the element asked for by ``range_header``. Returns False,
+        having sent nothing, if the header is to be ignored.
+        """
+        source = get_element_source(self.repository, handle, self.label)
+        if source is None:
+            self.not_found(handle)
+        try:
+            ranges = parse_ranges(range_header, source.size)
+            if ranges is None:
+                return False
+            self.write_ranges(source, ranges)
+            return True
+        finally:
+            source.close()
+
+    def write_ranges(self, source, ranges):
+        if not ranges:
+            self.set_status(416)
+            self.set_header('Content-Range', 'bytes */%d' % source.size)
+            return
+        bodies = source.read_ranges(ranges)
+        self.set_status(206)
+        if len(ranges) == 1:
+            (start, end), = ranges
+            self.set_header('Content-Type', source.mimetype)
+            self.set_header('Content-Range', 'bytes %d-%d/%d' % (start, end, source.size))
+            body = bodies[0]
+        else:
+            boundary = uuid.uuid4().hex
+            self.set_header('Content-Type', 'multipart/byteranges; boundary=%s' % boundary)
+            body = render.byteranges_multipart([(start, end, part) for (start, end), part in zip(ranges, bodies)],
+                                               source.mimetype, source.size, boundary)
+        self.set_header('Content-Length', str(len(body)))
+        self.write(body)
 
     def put(self, *args):
         raise tornado.web.HTTPError(405, "Method %s not allowed", ("PUT",))
@@ -87,17 +855,55 @@ class ShapeFileHandler(tornado.web.RequestHandler):
     def delete(self, *args):
         raise tornado.web.HTTPError(405, "Method %s not allowed", ("DELETE",))
 
-class ShapeMaskHandler(tornado.web.RequestHandler):
+class ShapeFileHandler(ElementHandler):
+    label = 'content'
+
+class ShapeMaskHandler(ElementHandler):
+    label = 'mask'
+
+class ShapeBundleHandler(BaseHandler):
+    """
+    A shape together with its file and mask, so a client needs one request instead of
+    three: a JSON document with the SVG embedded, or a multipart/mixed body whose parts
+    are the shape XML, the file and the mask.
+    """
     def prepare(self, *args, **kwargs):
-        self.repository = shapes.ShapeRepository(url=settings.DO_URL)
-        
+        self.repository = shapes.ShapeRepository(repository=get_repository())
+        return super(ShapeBundleHandler, self).prepare()
+
+    @tornado.gen.coroutine
     def get(self, handle):
-        shape = self.repository.get(handle)
-        try:
-            self.write(shape.mask.body)
-        except Exception, inst:
-            raise tornado.web.HTTPError(404, 'Mask not found for shape %s (%s)' % (handle, repr(inst)))
-        self.set_header('Content-Type', shape.file.mimetype)
+        format = self.negotiate_format()
+        rendered = cache.get_cache('rendered')
+        key = rendering_key('shape', handle, format)
+        cached_body, fresh = rendered.get_stale(key, CACHE_STALE_TIMEOUT)
+        generation = rendering_generation()
+        if cached_body is not None and not fresh:
+            refresh_rendering('shape', handle, format)
+
+        def load():
+            shape, shape_body = None, cached_body
+            if shape_body is None:
+                shape = self.repository.get(handle)
+                shape_body = self.serialize(shape, format)
+            elements = get_elements(self.repository, handle, shape=shape)
+            return shape_body, elements
+        shape_body, elements = yield self.in_thread(load)
+        if cached_body is None:
+            self.cache_result(rendered, key, shape_body, generation)
+        elements = {'file': elements.get('content'), 'mask': elements.get('mask')}
+        if format == 'json':
+            self.set_header('Content-Type', render.BUNDLE_FORMATS[format])
+            pieces = render.bundle_json(shape_body, elements)
+        else:
+            boundary = uuid.uuid4().hex
+            self.set_header('Content-Type', render.BUNDLE_FORMATS[format] % boundary)
+            pieces = render.bundle_multipart(shape_body, elements, boundary)
+        if any(isinstance(body, dorepository.MappedBody) for body, mimetype in filter(None, elements.values())):
+            # mapped elements are read a chunk at a time as they are sent
+            yield self.stream(pieces)
+        else:
+            self.write("".join(pieces))
 
     def put(self, *args):
         raise tornado.web.HTTPError(405, "Method %s not allowed", ("PUT",))
@@ -108,17 +914,156 @@ class ShapeMaskHandler(tornado.web.RequestHandler):
     def delete(self, *args):
         raise tornado.web.HTTPError(405, "Method %s not allowed", ("DELETE",))
 
+class ShapeBatchHandler(BaseHandler):
+    """
+    Runs many operations on shapes in one request (see ``ShapeRepository.batch``). The
+    body is a JSON list of operations, or an object with an ``operations`` list; the
+    response gives the result of each operation, in order. Deleting shapes requires the
+    ``seriously`` argument, as it does for a single shape.
+    """
+    deadline_seconds = BATCH_DEADLINE
+    write_admission = 'bulk'
 
-class CategoryHandler(tornado.web.RequestHandler):
     def prepare(self, *args, **kwargs):
-        self.cat_repository = shapes.CategoryRepository(url=settings.DO_URL)
+        self.repository = shapes.ShapeRepository(repository=get_repository())
+        return super(ShapeBatchHandler, self).prepare()
 
-    def get(self, handle=None, *args):
+    def get(self, *args):
+        raise tornado.web.HTTPError(405, "Method %s not allowed", ("GET",))
+
+    def put(self, *args):
+        raise tornado.web.HTTPError(405, "Method %s not allowed", ("PUT",))
+
+    @tornado.gen.coroutine
+    def post(self, *args):
+        try:
+            operations = render.json_backend.loads(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(400, "The body must be a JSON list of operations")
+        if isinstance(operations, dict):
+            operations = operations.get('operations')
+        if not isinstance(operations, list):
+            raise tornado.web.HTTPError(400, "The body must be a JSON list of operations")
+        if len(operations) > BATCH_MAX_OPERATIONS:
+            raise tornado.web.HTTPError(413, "At most %d operations can be sent at once", BATCH_MAX_OPERATIONS)
+        deleting = [operation for operation in operations if isinstance(operation, dict) and operation.get('op') == 'delete']
+        if deleting and not self.request.arguments.get('seriously', False):
+            raise tornado.web.HTTPError(405, "Method %s not allowed", ("DELETE",))
+        format = self.negotiate_format()
+        results = yield self.in_thread(self.repository.batch, operations)
+        if any(result['ok'] for result in results):
+            invalidate(*[result['id'] for result in results if result['ok'] and result['op'] == 'delete'])
+        self.set_header('Content-Type', render.FORMATS[format])
+        if format == 'json':
+            self.write(render.to_json(results))
+        else:
+            self.write(render.results_xml(results))
+
+    def delete(self, *args):
+        raise tornado.web.HTTPError(405, "Method %s not allowed", ("DELETE",))
+
+class ResponseStream(object):
+    """
+    A file-like object to which another thread writes the body of a response. What is
+    written is sent to the client a chunk at a time from the IOLoop, and the writing
+    thread waits for each chunk to be flushed before going on, so a slow client holds
+    up the writer instead of the response piling up in memory.
+    """
+    def __init__(self, handler, io_loop, chunk_size=EXPORT_CHUNK_SIZE):
+        self.handler = handler
+        self.io_loop = io_loop
+        self.chunk_size = chunk_size
+        self.buffer = []
+        self.size = 0
+        self.closed = False
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.closed:
+            raise IOError("The client closed the connection")
+        if not self.buffer:
+            return
+        chunk = "".join(self.buffer)
+        self.buffer, self.size = [], 0
+        flushed = threading.Event()
+        self.io_loop.add_callback(self._send, chunk, flushed)
+        flushed.wait()
+        if self.closed:
+            raise IOError("The client closed the connection")
+
+    def _send(self, chunk, flushed):
+        def done(future=None):
+            if future is not None and future.exception():
+                self.closed = True
+            flushed.set()
+        try:
+            self.handler.write(chunk)
+            self.handler.flush().add_done_callback(done)
+        except Exception:
+            self.closed = True
+            done()
+
+class ExportHandler(BaseHandler):
+    """
+    Streams an archive (``format=zip``, the default, or ``format=tar``) of the shapes of
+    a category, or of the whole library, with their files, masks and a manifest.
+    The archive is built in a separate thread while it is being sent.
+    """
+    deadline_seconds = EXPORT_DEADLINE
+    admission = 'bulk'
+
+    def prepare(self, *args, **kwargs):
+        self.repository = shapes.ShapeRepository(repository=get_repository())
+        self.cat_repository = shapes.CategoryRepository(repository=get_repository())
+        return super(ExportHandler, self).prepare()
+
+    @tornado.gen.coroutine
+    def get(self, handle=None):
+        format = self.get_argument('format', 'zip')
+        if format not in export.FORMATS:
+            raise tornado.web.HTTPError(400, "Unknown archive format %s", format)
         if handle:
-            self.write(self.cat_repository.get(handle).xml(True, details=True))
+            category = self.cat_repository.get(handle)
+            shape_list, filename = category.children, category.name
         else:
-            self.write(self.cat_repository.all().xml(True))
-        self.set_header('Content-Type', "text/xml")
+            shape_list, filename = self.repository.all(), 'shapes'
+        self.set_header('Content-Type', export.FORMATS[format])
+        self.set_header('Content-Disposition', 'attachment; filename="%s.%s"' % (
+                        re.sub(r'[^\w.-]+', '_', filename).strip('_') or 'shapes', format))
+        stream = ResponseStream(self, tornado.ioloop.IOLoop.current())
+        def run():
+            export.export(shape_list, stream, format)
+            stream.flush()
+        yield self.in_thread(run)
+
+    def put(self, *args):
+        raise tornado.web.HTTPError(405, "Method %s not allowed", ("PUT",))
+
+    def post(self, *args):
+        raise tornado.web.HTTPError(405, "Method %s not allowed", ("POST",))
+
+    def delete(self, *args):
+        raise tornado.web.HTTPError(405, "Method %s not allowed", ("DELETE",))
+
+
+class CategoryHandler(BaseHandler):
+    admission = 'listing'
+
+    def prepare(self, *args, **kwargs):
+        self.cat_repository = shapes.CategoryRepository(repository=get_repository())
+        return super(CategoryHandler, self).prepare()
+
+    @tornado.gen.coroutine
+    def get(self, handle=None, *args):
+        format = self.negotiate_format()
+        body = yield self.rendering('category', handle, format)
+        self.write(body)
+        self.set_header('Content-Type', render.FORMATS[format])
 
     def put(self, *args):
         raise tornado.web.HTTPError(405, "Method %s not allowed", ("PUT",))
@@ -126,8 +1071,11 @@ class CategoryHandler(tornado.web.RequestHandler):
     def post(self, *args):
         name = self.request.arguments['name'][0]
         category, created = self.cat_repository.get_or_create(name)
-        self.write(category.xml(True))
-        self.set_header('Content-Type', 'text/xml')
+        if created:
+            invalidate()
+        format = self.negotiate_format()
+        self.write(self.serialize(category, format, details=False))
+        self.set_header('Content-Type', render.FORMATS[format])
         if created:
             self.set_header('Location', category.url)
             self.set_status(201)
@@ -135,7 +1083,7 @@ class CategoryHandler(tornado.web.RequestHandler):
     def delete(self, *args):
         raise tornado.web.HTTPError(405, "Method %s not allowed", ("DELETE",))
     
-class CategoryFormHandler(tornado.web.RequestHandler):
+class CategoryFormHandler(BaseHandler):
     
     def get(self):
         self.render('templates/category.html')
@@ -155,12 +1103,166 @@ application = tornado.web.Application([
     (r"/shapes/entry/?", ShapeFormHandler),
     (r"/shapes/file/([^/]+)?/?", ShapeFileHandler),
     (r"/shapes/mask/([^/]+)?/?", ShapeMaskHandler),
+    (r"/shapes/export/?", ExportHandler),
+    (r"/shapes/batch/?", ShapeBatchHandler),
+    (r"/shapes/bundle/([^/]+)/?", ShapeBundleHandler),
     (r"/shapes/([^/]+)?/?", ShapeHandler),
     (r"/cats/entry/?", CategoryFormHandler),
+    (r"/cats/([^/]+)/export/?", ExportHandler),
     (r"/cats/([^/]+)?/?", CategoryHandler),
 ])
 
+class WorkerPool(object):
+    """
+    A pool of pre-forked worker processes serving ``application`` on shared sockets.
+
+    Workers that die are replaced. On SIGHUP the workers are restarted one at a time,
+    each one finishing its in-flight requests first, so the pool keeps serving
+    throughout. SIGTERM or SIGINT shut the whole pool down.
+    """
+    def __init__(self, sockets, processes):
+        self.sockets = sockets
+        self.processes = processes
+        self.workers = {}
+        self.restarting = []
+        self.running = True
+
+    def spawn(self, worker_id):
+        pid = os.fork()
+        if pid == 0:
+            for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, signal.SIG_DFL)
+            serve(self.sockets, worker_id)
+            os._exit(0)
+        self.workers[pid] = worker_id
+
+    def restart(self, *args):
+        self.restarting = list(self.workers)
+        self.restart_next()
+
+    def restart_next(self):
+        while self.restarting:
+            pid = self.restarting.pop(0)
+            if pid in self.workers:
+                self.terminate(pid)
+                return
+
+    def terminate(self, pid):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError, inst:
+            # the worker already exited; os.wait() will collect it
+            if inst.errno != errno.ESRCH:
+                raise
+
+    def shutdown(self, *args):
+        self.running = False
+        for pid in list(self.workers):
+            self.terminate(pid)
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self.restart)
+        signal.signal(signal.SIGTERM, self.shutdown)
+        signal.signal(signal.SIGINT, self.shutdown)
+        for worker_id in range(self.processes):
+            self.spawn(worker_id)
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except OSError, inst:
+                if inst.errno == errno.EINTR:
+                    continue
+                raise
+            worker_id = self.workers.pop(pid, None)
+            if self.running and worker_id is not None:
+                self.spawn(worker_id)
+                self.restart_next()
+
+_syncing = []
+def sync_mirror():
+    """
+    Pick up changes made to the repository since the last sync of the local mirror,
+    from a thread of its own so that the repository's answers don't hold up the
+    IOLoop. A sync still running when the next one is due isn't started twice.
+    """
+    if _syncing:
+        return
+    _syncing.append(True)
+    io_loop = tornado.ioloop.IOLoop.current()
+    def done(changed, deleted):
+        _syncing.pop()
+        if changed or deleted:
+            log.info("Mirror sync: %d changed, %d deleted", changed, deleted)
+            invalidate()
+    def run():
+        changed = deleted = 0
+        try:
+            changed, deleted = get_repository().sync()
+        except Exception:
+            log.exception("Mirror sync failed")
+        finally:
+            io_loop.add_callback(done, changed, deleted)
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+
+def check_health():
+    """
+    Probe the replicas of the repository's shards from a thread of its own, so that a
+    server that doesn't answer doesn't hold up the IOLoop.
+    """
+    thread = threading.Thread(target=get_repository().check_health)
+    thread.daemon = True
+    thread.start()
+
+def serve(sockets=None, worker_id=0):
+    """
+    Serve ``application`` until SIGTERM, then stop accepting connections and let
+    in-flight requests finish (for at most ``settings.SHUTDOWN_GRACE`` seconds).
+
+    Background tasks shared by the whole pool, like syncing the mirror every
+    ``settings.SYNC_INTERVAL`` seconds, only run in the first worker. Every worker
+    checks the health of replicated shards every ``settings.DO_HEALTH_CHECK_INTERVAL``
+    seconds, since each one keeps track of which replicas it can use.
+    """
+    server = tornado.httpserver.HTTPServer(application)
+    if sockets:
+        server.add_sockets(sockets)
+    else:
+        server.listen(settings.PORT, settings.HOST)
+    io_loop = tornado.ioloop.IOLoop.instance()
+    deadline = []
+
+    def stop_when_idle():
+        if BaseHandler.active_requests <= 0 or time.time() > deadline[0]:
+            io_loop.stop()
+        else:
+            io_loop.add_timeout(time.time() + 0.1, stop_when_idle)
+
+    def stop():
+        server.stop()
+        deadline.append(time.time() + SHUTDOWN_GRACE)
+        stop_when_idle()
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: io_loop.add_callback_from_signal(stop))
+    if worker_id == 0 and MIRROR_PATH and SYNC_INTERVAL:
+        tornado.ioloop.PeriodicCallback(sync_mirror, SYNC_INTERVAL * 1000).start()
+    if HEALTH_CHECK_INTERVAL and any(len(shard.replicas) > 1 for shard in get_repository().shards):
+        tornado.ioloop.PeriodicCallback(check_health, HEALTH_CHECK_INTERVAL * 1000).start()
+    io_loop.start()
+
+def main():
+    repository = get_repository()
+    if MIRROR_PATH and not repository.mirror.ready:
+        repository.rebuild()
+    if WARM_UP:
+        warm_up()
+    processes = PROCESSES or tornado.process.cpu_count()
+    if processes == 1:
+        serve()
+    else:
+        sockets = tornado.netutil.bind_sockets(settings.PORT, settings.HOST)
+        WorkerPool(sockets, processes).run()
+
 if __name__ == "__main__":
-    application.listen(settings.PORT, settings.HOST)
-    tornado.ioloop.IOLoop.instance().start()
-    
+    main()
@@ -4,9 +4,54 @@ PORT=80 # port for the Shapes server
 DO_HOST="" # hostname/ip for the DO server
 DO_PORT=80 # port for the DO server 
 DO_URL = 'http://%s:%d/do/' % (DO_HOST, DO_PORT)
+# DO_URL may also be a list of shards, each a URL or a list of replica URLs (the first takes the writes):
+# DO_URL = [['http://do-a1/do/', 'http://do-a2/do/'], 'http://do-b/do/']
 DO_USER=""  	#username for DO repository
 DO_PASSWORD="" 	#password for DO repository
 SHAPE_URL = 'http://' + HOST + ':' + str(PORT) +'/shapes/%s/'
 FILE_URL = 'http://' + HOST + ':' + str(PORT) +'/shapes/file/%s/'
 MASK_URL = 'http://' + HOST + ':' + str(PORT) +'/shapes/mask/%s/'
 CATEGORY_URL =  'http://' + HOST + ':' + str(PORT) +'/cats/%s/'
+PROFILE_HEADERS=False # send X-DO-Requests/X-DO-Time debug headers with every response
+SLOW_REQUEST_THRESHOLD=1.0 # requests slower than this (in seconds) are logged with their DO call breakdown
+PROFILE_SAMPLE_RATE=0.0 # fraction of requests run under cProfile; dumps are written for slow ones
+PROFILE_DIR=None # directory for cProfile dumps of slow requests
+PROCESSES=1 # number of worker processes to pre-fork; 0 means one per CPU
+SHUTDOWN_GRACE=10.0 # seconds a stopping worker waits for in-flight requests
+CACHE_DIR=None # directory for the cache shared by all worker processes; None disables it
+CACHE_TIMEOUT=300 # seconds rendered listings and records are kept in the shared cache
+MIRROR_PATH=None # SQLite database for a local mirror of shape and category records used to answer searches
+SYNC_INTERVAL=60 # seconds between incremental syncs of the mirror with the DO repository; 0 disables them
+MIRROR_DELETION_CHECK_INTERVAL=3600 # seconds between the full listings of the DO repository done by a sync to find objects deleted elsewhere
+DO_TIMEOUT=10.0 # seconds before a request to the DO server is abandoned
+DO_RETRIES=2 # times a failed GET to the DO server is retried (with jittered exponential backoff)
+DO_RETRY_BACKOFF=0.1 # seconds before the first retry; doubles for every further retry
+DO_HEDGE_PERCENTILE=None # e.g. 95: resend GETs slower than this percentile of recent latencies
+DO_BREAKER_THRESHOLD=5 # consecutive DO failures before requests fail fast; 0 disables the breaker
+DO_BREAKER_RESET=30.0 # seconds requests fail fast before the DO server is tried again
+REQUEST_DEADLINE=30.0 # seconds a request may spend waiting on the DO server before it is cut short
+EXPORT_WORKERS=4 # number of shape files downloaded at once when exporting an archive
+EXPORT_DEADLINE=3600 # seconds an archive export may spend on requests to the DO repository
+EXPORT_CHUNK_SIZE=65536 # bytes of an archive export sent to the client at a time
+BATCH_WORKERS=4 # number of shapes worked on at once by a batch of operations
+BATCH_DEADLINE=600 # seconds a batch of operations may spend on requests to the DO repository
+BATCH_MAX_OPERATIONS=10000 # largest number of operations accepted in one batch request
+OBJECT_CACHE_SIZE=1000 # shapes or categories kept by each list as it is walked; None for no limit
+KEEP_FILE_BODIES=True # False to download shape files again each time instead of keeping them in memory
+SPOOL_THRESHOLD=1048576 # shape files larger than this many bytes are kept in temporary files instead of memory
+SPOOL_DIR=None # directory for those temporary files; None for the system default
+QUERY_MAX_TERMS=50 # searches for more categories or handles than this are split into several queries
+SEARCH_WORKERS=4 # how many of those queries are run at the same time
+CACHE_STALE_TIMEOUT=3600 # seconds past CACHE_TIMEOUT a rendering is still served while it is refreshed in the background
+WARM_UP=True # fill the cache (needs CACHE_DIR) with the listings, categories and newest shapes before serving
+WARM_UP_SHAPES=100 # how many of the newest shapes to warm up
+WARM_UP_DEADLINE=300 # seconds the warm-up may take
+DO_HEALTH_CHECK_INTERVAL=30 # seconds between health checks of the replicas of a shard
+SHARD_VIRTUAL_NODES=64 # points per shard on the consistent hashing ring that places new objects
+LOCATION_CACHE_SIZE=100000 # how many handles to remember the shard of
+ADMISSION_CONTROL=True # queue requests and turn some away (503) when the server is overloaded
+MAX_CONCURRENT_REQUESTS=100 # requests handled at once; more wait in a queue
+MAX_QUEUED_REQUESTS=200 # requests waiting at most; when full, the least important ones are turned away
+ADMISSION_LIMITS={} # {'listing': (4, 1.0), ...}: requests at once and longest wait in seconds for a class of requests (element, shape, write, listing, bulk)
+MINIFY_SVG=True # strip comments and whitespace that doesn't matter from SVG files and masks as they are uploaded
+DEDUP_MIN_SIZE=4096 # files of at least this many bytes are stored once however often they are uploaded; None to turn this off
@@ -75,11 +75,15 @@ True
 0
 >>> len(final_matching_shapes) - len(old_matching_shapes)
 0"""
-import sys
-from dorepository import escape_for_url, DigitalObjectRepository, DigitalObject
-import settings
+import sys, collections
+from dorepository import escape_for_url, DigitalObjectRepository, DigitalObject, ObjectRecord, DeadlineExceeded, parallel_map
+from dorepository import LRUCache, OBJECT_CACHE_SIZE, get_file_container, guess_type
+from render import NAMESPACE
+from minify import minify_svg
+import settings, render, query
 
-NAMESPACE=' xmlns:xlink="http://www.w3.org/1999/xlink"'
+BATCH_WORKERS = getattr(settings, 'BATCH_WORKERS', 4)
+MINIFY_SVG = getattr(settings, 'MINIFY_SVG', True)
 
 class ShapesException(Exception):
     pass
@@ -100,18 +104,45 @@ class MultipleShapesFound(ShapesException):
 class CategoryNotFound(ShapesException):
     pass
 
+class InvalidOperation(ShapesException):
+    pass
+
 class MultipleCategoriesFound(ShapesException):
     pass
 
+class memoized_property(object):
+    """
+    A property computed once per object; the value is stored in the instance
+    dictionary, which takes precedence on later lookups. Delete the attribute
+    (``del shape.file``) to have it computed again.
+    """
+    def __init__(self, function):
+        self.function = function
+        self.__name__ = function.__name__
+        self.__doc__ = function.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = instance.__dict__[self.__name__] = self.function(instance)
+        return value
+
 class BaseList(object):
-    def __init__(self, repository=None, digital_object_list=None, handles=[]):
+    """
+    A list of shapes or categories, built from their handles or from the results of a
+    search (ObjectRecords, which hold no file bodies). The shapes or categories are
+    loaded, or built from their records, when they are first needed; at most
+    ``cache_size`` of them (``settings.OBJECT_CACHE_SIZE``, None for no limit) are
+    kept, the least recently used being dropped first along with anything they loaded.
+    """
+    def __init__(self, repository=None, digital_object_list=None, handles=None, cache_size=OBJECT_CACHE_SIZE):
         self.repository = repository
         self.digital_object_list=digital_object_list
-        if self.digital_object_list:
+        if self.digital_object_list is not None:
             self.object_handles = self.digital_object_list.object_handles
         else:
-            self.object_handles=handles
-        self.objects = {}
+            self.object_handles=list(handles or [])
+        self.objects = LRUCache(cache_size)
         self.index = 0
     
     def __len__(self):
@@ -129,15 +160,19 @@ class BaseList(object):
     def get_object(self, handle):
         if isinstance(handle, self.repository.object_cls):
             return handle
-        elif isinstance(handle, DigitalObject):
+        if isinstance(handle, DigitalObject):
             return self.repository.object_cls(digital_object=handle, repository=self.repository)
+        key = handle.handle if isinstance(handle, ObjectRecord) else handle
         try:
-            obj = self.objects.get(handle, None)
+            obj = self.objects.get(key, None)
         except TypeError:
             raise Exception("We have a %s" % repr(handle))
-        if not obj:
-            obj = self.repository.get(handle)
-            self.objects[handle] = obj
+        if obj is None:
+            if isinstance(handle, ObjectRecord):
+                obj = self.repository.object_cls(digital_object=handle.digital_object(self.repository.repository), repository=self.repository)
+            else:
+                obj = self.repository.get(handle)
+            self.objects[key] = obj
         return obj
     
     def __getitem__(self, index):
@@ -154,8 +189,42 @@ class BaseList(object):
 
 
 class ShapeList(BaseList):
+    def category_handles(self):
+        """
+        The handles of the categories of the shapes, each once, read from the records
+        of the list where it has them.
+        """
+        handles = []
+        for item in self.object_handles:
+            attributes = getattr(item, 'attributes', None)
+            if attributes is None:
+                attributes = self.get_object(item).digital_object.attributes
+            for handle in (attributes.get('category') or '').split(','):
+                if handle and handle not in handles:
+                    handles.append(handle)
+        return handles
+
+    def data(self, details=True):
+        """
+        The shapes as plain data. With details, the categories of all of them are looked
+        up together and shared between the shapes.
+        """
+        categories = None
+        if details:
+            category_repository = CategoryRepository(repository=self.repository.repository)
+            categories = category_repository.get_many(self.category_handles())
+        result = []
+        for shape in self:
+            if categories is not None:
+                shape.share_categories(categories)
+            result.append(shape.data(details))
+        return result
+
     def xml(self, namespace=True, details=True):
-        return '<Shapes%(namespace)s>%(shapes)s</Shapes>' % {'namespace': NAMESPACE if namespace else "", 'shapes': "".join([shape.xml(False, details) for shape in self])}
+        return render.shapes_xml(self.data(details), namespace)
+
+    def json(self, details=True):
+        return render.to_json(self.data(details))
 
 
 
@@ -181,13 +250,57 @@ class ShapeFile(object):
         except:
             raise AttributeError("'%s' object has no attribute '%s'." % (type(self).__name__, name))
 
+    def data(self):
+        return {
+            'href': self.url,
+            'type': self.do_file.mimetype,
+            'name': self.do_file.filename,
+        }
+
     def __repr__(self):
         if self.type:
             return "<%s %s (%s, %s)>" % (type(self).__name__, self.do_file.filename, self.type, self.do_file.mimetype)
         else:
             return "<%s %s (%s)>" % (type(self).__name__, self.do_file.filename, self.do_file.mimetype)
 
+def prepare_file(file):
+    """
+    Returns ``file`` (anything ``DigitalObject.put_file`` takes) ready to be stored: SVG
+    documents are minified (see ``minify.py``) unless ``settings.MINIFY_SVG`` is False.
+    The body is read once, here, and handed on as it is read.
+    """
+    if not MINIFY_SVG or file is None:
+        return file
+    container = get_file_container(file)
+    mimetype = container.get('mimetype') or guess_type(container['filename'])
+    body = container['body']
+    if mimetype == 'image/svg+xml':
+        body = minify_svg(body)
+    return {'filename': container['filename'], 'content_type': mimetype, 'body': body}
+
 SHAPE_ATTRIBUTES = ['name', 'description', 'classroom', 'creator', 'school', ]
+class ShapeBatch(object):
+    """
+    The batch of a shape (see ``Shape.batch``): that of its DigitalObject, which puts
+    the attributes back as they were if it fails, and which then also forgets the
+    category list built from them, to be built again from the restored attribute.
+    """
+    def __init__(self, shape):
+        self.shape = shape
+        self.attribute_batch = shape.digital_object.batch()
+
+    def __enter__(self):
+        return self.attribute_batch.__enter__()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.attribute_batch.__exit__(exc_type, exc_value, traceback)
+        except Exception:
+            self.shape.__dict__.pop('_categories', None)
+            raise
+        if exc_type is not None:
+            self.shape.__dict__.pop('_categories', None)
+
 class Shape(object):
     def __init__(self, digital_object, repository):
         self.digital_object = digital_object
@@ -210,12 +323,21 @@ class Shape(object):
     def add_category(self, category):
         self.categories.add(category)
         self.digital_object.set('category', str(self.categories))
+
+    def batch(self):
+        """
+        Returns a context in which the attribute changes and categories added to the shape
+        are written together when it ends (``with shape.batch(): shape.add_category(...)``),
+        the category list once however many categories were added. If it fails, the
+        categories are put back as they were along with the attributes.
+        """
+        return ShapeBatch(self)
     
-    @property
+    @memoized_property
     def url(self):
         return settings.SHAPE_URL % escape_for_url(self.digital_object.handle)
 
-    @property
+    @memoized_property
     def mask(self):
         mask_digital_file_object = self.digital_object.files.get('mask', None)
         if mask_digital_file_object:
@@ -223,7 +345,7 @@ class Shape(object):
         else:
             return None
 
-    @property
+    @memoized_property
     def file(self):
         digital_file_object = self.digital_object.files.get('content', None)
         if digital_file_object:
@@ -236,45 +358,57 @@ class Shape(object):
         if not hasattr(self, '_categories'):
             category_list = self.get('category',"")
             if category_list:
-                self._categories = CategoryList(repository = CategoryRepository(url=self.repository.url), handles=category_list.split(','))
+                self._categories = CategoryList(repository = CategoryRepository(repository=self.repository.repository), handles=category_list.split(','))
             else:
-                self._categories = CategoryList(repository = CategoryRepository(url=self.repository.url))
+                self._categories = CategoryList(repository = CategoryRepository(repository=self.repository.repository))
         return self._categories      
 
-    def xml(self, namespace=True, details=True):
-        xml = []
-        xml.append('<Shape name="%(name)s" created="%(created)s" id="%(handle)s"%(namespace)s xlink:href="%(link)s"' % {
-            'name': self.name,
-            'created': self.created,
-            'handle': self.handle,
-            'namespace': NAMESPACE if namespace else '',
-            'link': self.url
-        })
+    def share_categories(self, categories):
+        """
+        Builds the category list of the shape with those of its categories that are in
+        ``categories`` (Category objects by handle) rather than looking each one up.
+        """
+        if hasattr(self, '_categories'):
+            return
+        handles = [handle for handle in self.get('category', "").split(',') if handle]
+        self._categories = CategoryList(repository=CategoryRepository(repository=self.repository.repository), handles=handles)
+        for handle in handles:
+            if handle in categories:
+                self._categories.objects[handle] = categories[handle]
+
+    def data(self, details=True):
+        """
+        The shape as plain data, from which both the XML and JSON representations are rendered.
+        """
+        digital_object = self.digital_object
+        data = {
+            'id': digital_object.handle,
+            'name': digital_object.get('name'),
+            'created': str(digital_object.created),
+            'href': self.url,
+        }
         if details:
-            xml.append('>')
-            if self.file:
-                xml.append('<File xlink:href="%(url)s" type="%(type)s" name="%(name)s" />' % {
-                                                                                             'url': self.file.url,
-                                                                                             'type': self.file.mimetype,
-                                                                                             'name': self.file.filename
-                                                                                             })
-            if self.mask:
-                xml.append('<Mask xlink:href="%(url)s" type="%(type)s" name="%(name)s" />' % {
-                                                                                             'url': self.mask.url,
-                                                                                             'type': self.mask.mimetype,
-                                                                                             'name': self.mask.filename
-                                                                                             })
-            if self.categories:
-                xml.append(self.categories.xml(False))
-            xml.append("</Shape>")
-        else:
-            xml.append(" />")
-        return "".join(xml)
+            for key, shape_file in (('file', self.file), ('mask', self.mask)):
+                data[key] = shape_file and shape_file.data()
+            try:
+                data['categories'] = self.categories.data()
+            except DeadlineExceeded, inst:
+                # Out of time: list the shape without its categories rather than fail
+                inst.deadline.degrade('categories')
+                data['categories'] = []
+        return data
+
+    def xml(self, namespace=True, details=True):
+        return render.shape_xml(self.data(details), namespace)
+
+    def json(self, details=True):
+        return render.to_json(self.data(details))
         
     
 
     def put_file(self, file, label='content'):
-        self.digital_object.put_file(label, file)
+        self.digital_object.put_file(label, prepare_file(file))
+        self.__dict__.pop('mask' if label == 'mask' else 'file', None)
 
     def put_mask(self, file):
         self.put_file(file, 'mask')
@@ -289,20 +423,18 @@ class ShapeRepository(object):
         self.repository = repository or DigitalObjectRepository(url)
         self.url = url or self.repository.url
 
-    def search(self, query_string='', categories=None):
-        query = []
-        if query_string:
-            query.append(query_string)
+    def search(self, query_string='', categories=None, handles=None):
+        """
+        Shapes matching ``query_string`` (in the repository's query language), in any of
+        ``categories`` (Category objects or handles) and, if given, with one of ``handles``.
+        Long lists of categories or handles are searched for in several parallel queries.
+        """
+        node = query.all_of(query.term('objatt_type', 'shape'), query.raw(query_string))
         if categories:
-            cat_query = []
-            for cat in categories:
-                try:
-                    cat_query.append("objatt_category:%s" % cat.handle)
-                except AttributeError:
-                    cat_query.append("objatt_category:%s" % cat)
-            query.append("(%s)" % "".join(cat_query))
-        query = "objatt_type:shape AND (%s)" % (" AND ".join(query))
-        return ShapeList(digital_object_list=self.repository.search(query), repository=self)
+            node[1].append(query.any_of('objatt_category', [getattr(cat, 'handle', cat) for cat in categories]))
+        if handles:
+            node[1].append(query.any_of('id', handles))
+        return ShapeList(digital_object_list=query.search(self.repository, node), repository=self)
             
     def all(self):
         return ShapeList(digital_object_list=self.repository.search("objatt_type:shape"), repository=self)
@@ -318,9 +450,9 @@ class ShapeRepository(object):
         data = kwargs
         files = {}
         if file:
-            files['content'] = file
+            files['content'] = prepare_file(file)
         if mask:
-            files['mask'] = mask
+            files['mask'] = prepare_file(mask)
         if categories:
             category_list = CategoryList(names=[cat for cat in categories if cat], repository=CategoryRepository(repository=self.repository))
             data['category'] = str(category_list)
@@ -329,26 +461,125 @@ class ShapeRepository(object):
         digital_object = self.repository.create(files=files, data=data)
         return Shape(digital_object=digital_object, repository=self)
 
+    def batch(self, operations, max_workers=BATCH_WORKERS):
+        """
+        Runs a list of operations on shapes and returns one result per operation, in order.
+
+        Each operation is a dict with the ``op`` to run and the ``id`` of the shape:
+        ``delete``, ``set`` (with the ``name`` and ``value`` of an attribute) or
+        ``add_category`` (with a ``category`` name or handle; missing categories are
+        created). Each result is a dict with the ``op`` and ``id`` of its operation,
+        ``ok`` and, if the operation failed, an ``error`` message.
+
+        Operations on the same shape run in the order given, after a single lookup of
+        the shape; different shapes are handled in parallel, ``max_workers`` at a time.
+        A failed operation doesn't stop the others.
+        """
+        operations = [utf8_operation(operation) for operation in operations]
+        results = [None] * len(operations)
+        indices_by_handle = collections.OrderedDict()
+        categories = {}
+        category_repository = CategoryRepository(repository=self.repository)
+        for index, operation in enumerate(operations):
+            try:
+                check_operation(operation)
+                if operation['op'] == 'add_category' and operation['category'] not in categories:
+                    # resolved here, once each, so that parallel workers never create the same category twice
+                    categories[operation['category']] = category_repository.create(operation['category'])
+            except Exception, inst:
+                results[index] = operation_result(operation, inst)
+            else:
+                indices_by_handle.setdefault(operation['id'], []).append(index)
+
+        def run(handle):
+            indices = indices_by_handle[handle]
+            try:
+                shape = self.get(handle)
+            except Exception, inst:
+                for index in indices:
+                    results[index] = operation_result(operations[index], inst)
+                return
+            deleted = False
+            for index in indices:
+                operation = operations[index]
+                try:
+                    if deleted:
+                        raise ShapeNotFound("Shape %s was deleted by an earlier operation" % handle)
+                    if operation['op'] == 'delete':
+                        shape.delete()
+                        deleted = True
+                    elif operation['op'] == 'set':
+                        shape.digital_object.set(operation['name'], operation['value'])
+                    else:
+                        shape.add_category(categories[operation['category']])
+                except Exception, inst:
+                    results[index] = operation_result(operation, inst)
+                else:
+                    results[index] = operation_result(operation)
+
+        parallel_map(run, indices_by_handle.keys(), max_workers)
+        return results
+
+BATCH_OPERATIONS = {
+    'delete': (),
+    'set': ('name', 'value'),
+    'add_category': ('category',),
+}
+PROTECTED_ATTRIBUTES = ('type', 'category')
+
+def check_operation(operation):
+    """
+    Raises InvalidOperation unless ``operation`` is a batch operation ShapeRepository.batch can run.
+    """
+    if not isinstance(operation, dict) or not operation.get('id') or operation.get('op') not in BATCH_OPERATIONS:
+        raise InvalidOperation("An operation needs an id and an op (one of %s)" % ", ".join(sorted(BATCH_OPERATIONS)))
+    for key in BATCH_OPERATIONS[operation['op']]:
+        if not isinstance(operation.get(key), basestring):
+            raise InvalidOperation("A %s operation needs a %s" % (operation['op'], key))
+    if operation['op'] == 'set' and operation['name'] in PROTECTED_ATTRIBUTES:
+        raise InvalidOperation("The %s attribute can't be set directly" % operation['name'])
+
+def utf8_operation(operation):
+    if not isinstance(operation, dict):
+        return operation
+    return dict((key, value.encode('utf-8') if isinstance(value, unicode) else value) for key, value in operation.items())
+
+def operation_result(operation, error=None):
+    if not isinstance(operation, dict):
+        operation = {}
+    result = {'op': operation.get('op'), 'id': operation.get('id'), 'ok': error is None}
+    if error is not None:
+        result['error'] = str(error).strip() or type(error).__name__
+    return result
+
 
 
 class CategoryList(BaseList):
     def __init__(self, repository=None, names=None, handles=None, *args, **kwargs):
-        super(CategoryList, self).__init__(repository=repository, *args, **kwargs)
+        super(CategoryList, self).__init__(repository=repository, handles=handles, *args, **kwargs)
         if names:
             for name in names:
                 self.add(name)
     
     def add(self, obj):
-        if obj not in self.object_handles:
-            if not isinstance(obj, Category):
-                category_object = self.repository.create(obj)
-            else:
-                category_object = obj
+        if obj in self.object_handles:
+            return
+        if not isinstance(obj, Category):
+            category_object = self.repository.create(obj)
+        else:
+            category_object = obj
+        if category_object.handle not in self.object_handles:
             self.objects[category_object.handle] = category_object
             self.object_handles.append(category_object.handle)
 
+    def data(self, details=False):
+        return [cat.data(details) for cat in self]
+
     def xml(self, namespace=True, details=False):
-        return "<Categories%(namespace)s>%(cats)s</Categories>" % {'namespace': NAMESPACE if namespace else "", 'cats': "".join(cat.xml(False, details) for cat in self)}
+        return render.categories_xml(self.data(details), namespace)
+
+    def json(self, details=False):
+        return render.to_json(self.data(details))
 
 
 class Category(object):
@@ -362,7 +593,7 @@ class Category(object):
         except:
             raise AttributeError("'%s' object has no attribute '%s'" % (type(self).__name__, name))
         
-    @property
+    @memoized_property
     def url(self):
         return settings.CATEGORY_URL % escape_for_url(self.digital_object.handle)
 
@@ -380,28 +611,27 @@ class Category(object):
     @property
     def children(self):
         if not hasattr(self, '_children'):
-            self._children = ShapeRepository(url=self.repository.url).search(categories=[self])
+            self._children = ShapeRepository(repository=self.repository.repository).search(categories=[self])
         return self._children 
 
-    def xml(self, namespace=True, details=False):
-        xml = []
-        xml.append('<Category id="%(handle)s" name="%(name)s"' % {
-                                                                  'handle': self.digital_object.handle, 
-                                                                  'name': self.name,
-                                                                  })
-        if namespace:
-            xml.append(' xmlns:xlink="http://www.w3.org/1999/xlink"')
-        xml.append(' xlink:href="%(link)s"' % {
-                                               'link': self.url
-                                               })
+    def data(self, details=False):
+        """
+        The category as plain data, from which both the XML and JSON representations are rendered.
+        """
+        data = {
+            'id': self.digital_object.handle,
+            'name': self.digital_object.get('name'),
+            'href': self.url,
+        }
         if details:
-            xml.append('>')
-            if self.children:
-                xml.append(self.children.xml(False, False))
-            xml.append('</Category>')
-        else:
-            xml.append(' />')
-        return "".join(xml)
+            data['shapes'] = self.children.data(False)
+        return data
+
+    def xml(self, namespace=True, details=False):
+        return render.category_xml(self.data(details), namespace)
+
+    def json(self, details=False):
+        return render.to_json(self.data(details))
 
 
 
@@ -434,7 +664,7 @@ class CategoryRepository(object):
         Returns a Category object
         """
         exact_matches = []
-        for result in self.search(query="id:%(handle)s OR objatt_name:%(name)s" % {'handle': name, 'name': name }):
+        for result in self.search(query=query.to_query(query.either(query.term('id', name), query.term('objatt_name', name)))):
             if result.name == name or result.handle == name:
                 exact_matches.append(result)
         if not exact_matches:
@@ -443,6 +673,18 @@ class CategoryRepository(object):
             raise MultipleCategoriesFound("More than one category found for %s" % name)
         return exact_matches[0]
 
+    def get_many(self, handles):
+        """
+        Returns a dict of the categories with ``handles``, found with a single search
+        (split up by the query planner if there are many of them). Handles of categories
+        that don't exist are left out.
+        """
+        if not handles:
+            return {}
+        node = query.all_of(query.term('objatt_type', 'category'), query.any_of('id', handles))
+        categories = CategoryList(digital_object_list=query.search(self.repository, node), repository=self)
+        return dict((category.handle, category) for category in categories)
+
     def get_or_create(self, category):
         """
         Searches the repository for a matching category. If none is found, it creates a new one.
@@ -453,7 +695,7 @@ class CategoryRepository(object):
             return self.get(category), False
         except CategoryNotFound:
             digital_object = self.repository.create(data={'name': category, 'type': 'category'})
-            return Category(digital_oject=digital_object, repository=self.repository), True
+            return Category(digital_object=digital_object, repository=self), True
 
     def create(self, name=None):
         """